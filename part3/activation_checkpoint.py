@@ -0,0 +1,73 @@
+import contextlib
+import functools
+from typing import Iterable
+
+import torch
+from torch import nn
+from torch.utils.checkpoint import checkpoint
+
+# Activation checkpointing for VanillaVAE blocks.
+#
+# enable_checkpointing(model, ["encoder.0", "encoder.1", "final_layer"]) makes
+# those submodules keep only their input during a training forward and rerun
+# themselves during backward. Any name from model.named_modules() works: a
+# single stage ("decoder.3") drops the conv and BatchNorm outputs inside it,
+# a whole stack ("encoder") keeps one input for all of its stages. The forward
+# is patched on the instance, so the state_dict is unchanged; eval mode and
+# no_grad run the blocks normally.
+#
+# bench_checkpointing.py measures the memory saved and the extra step time
+# for each configuration.
+
+
+def _batch_norms(module: nn.Module):
+    return [
+        m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)
+    ]
+
+
+@contextlib.contextmanager
+def _frozen_batch_norm(module: nn.Module):
+    """Recomputation must not fold the batch into the running stats a second time."""
+    batch_norms = _batch_norms(module)
+    saved = [(bn.momentum, bn.num_batches_tracked.clone()) for bn in batch_norms]
+    for bn in batch_norms:
+        bn.momentum = 0.0
+    try:
+        yield
+    finally:
+        for bn, (momentum, num_batches_tracked) in zip(batch_norms, saved):
+            bn.momentum = momentum
+            bn.num_batches_tracked.copy_(num_batches_tracked)
+
+
+def _checkpointed_forward(module: nn.Module, forward, *args):
+    if not (module.training and torch.is_grad_enabled()):
+        return forward(*args)
+    return checkpoint(
+        forward,
+        *args,
+        use_reentrant=False,
+        context_fn=lambda: (contextlib.nullcontext(), _frozen_batch_norm(module)),
+    )
+
+
+def enable_checkpointing(model: nn.Module, names: Iterable[str]) -> None:
+    """Recompute the named submodules of model during backward."""
+    modules = dict(model.named_modules())
+    for name in names:
+        if name not in modules:
+            raise ValueError(f"No module named {name!r} to checkpoint")
+        module = modules[name]
+        module.forward = functools.partial(
+            _checkpointed_forward, module, module.forward
+        )
+
+
+def stage_names(model: nn.Module) -> list:
+    """Every encoder and decoder stage plus final_layer, one checkpoint each."""
+    return (
+        [f"encoder.{i}" for i in range(len(model.encoder))]
+        + [f"decoder.{i}" for i in range(len(model.decoder))]
+        + ["final_layer"]
+    )
@@ -0,0 +1,32 @@
+import torch
+import torch.nn.functional as F
+from torchvision import transforms
+
+# "batch" pipeline mode: DataLoader workers only decode (PIL -> uint8 CHW tensor)
+# and the default collate stacks the raw images. The main process then resizes,
+# casts and scales the whole batch at once with BatchTransform, right before
+# images.to(device). This requires every image in a batch to decode to the same
+# size, which holds for img_align_celeba (178x218, or 89x109 with "draft").
+
+# Per-sample transform for the workers in "batch" mode
+sample_transform = transforms.PILToTensor()
+
+
+class BatchTransform:
+
+    def __init__(self, img_size: int) -> None:
+        self.size = (img_size, img_size)
+
+    def __call__(self, images: torch.Tensor) -> torch.Tensor:
+        if images.dtype == torch.uint8:
+            images = images.float().div_(255)
+        if tuple(images.shape[-2:]) != self.size:
+            # antialias=True matches the PIL bilinear filter used by transforms.Resize
+            images = F.interpolate(
+                images,
+                size=self.size,
+                mode="bilinear",
+                align_corners=False,
+                antialias=True,
+            ).clamp_(0, 1)
+        return images
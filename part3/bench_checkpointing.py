@@ -0,0 +1,133 @@
+import json
+import os
+import resource
+import time
+
+import torch
+import torch.multiprocessing as mp
+from torch.optim import Adam
+
+from activation_checkpoint import enable_checkpointing, stage_names
+from vae_model import VanillaVAE, configs
+
+# Memory saved vs. extra step time of activation checkpointing strategies.
+#
+# Each (config, strategy) pair trains a few steps on synthetic images in a
+# fresh process. Training memory is the peak RSS minus the RSS once the model
+# is built, so it covers activations, gradients and optimizer state; the
+# saving is relative to "none" for the same config.
+
+config_names = ["celeba64", "celeba128", "mnist"]
+batch_size = 256
+warmup_steps = 1
+timed_steps = 5
+kld_weight = 0.00025
+results_path = "./results/checkpointing_report.json"
+
+
+def strategies(model) -> dict:
+    stages = stage_names(model)
+    return {
+        "none": [],
+        # The two highest-resolution stages on each side hold most activations
+        "outer": stages[:2] + stages[-3:],
+        "stages": stages,
+        "stacks": ["encoder", "decoder", "final_layer"],
+    }
+
+
+def _current_rss() -> int:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def run(config_name: str, strategy: str) -> dict:
+    config = configs[config_name]
+    torch.manual_seed(42)
+    model = VanillaVAE(**config)
+    enable_checkpointing(model, strategies(model)[strategy])
+    optimizer = Adam(model.parameters(), lr=0.005)
+    shape = (batch_size, config["in_channels"], config["img_size"], config["img_size"])
+    images = torch.rand(shape)
+    baseline = _current_rss()
+
+    def step():
+        optimizer.zero_grad()
+        loss = model.loss_function(*model(images), M_N=kld_weight)["loss"]
+        loss.backward()
+        optimizer.step()
+
+    for _ in range(warmup_steps):
+        step()
+    start = time.perf_counter()
+    for _ in range(timed_steps):
+        step()
+    step_time = (time.perf_counter() - start) / timed_steps
+    # ru_maxrss is in KiB on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return {"step_time_s": step_time, "training_memory_bytes": peak - baseline}
+
+
+def _spawned(config_name: str, strategy: str, results) -> None:
+    try:
+        results.put(run(config_name, strategy))
+    except Exception as error:
+        results.put({"error": repr(error)})
+
+
+def table() -> dict:
+    context = mp.get_context("spawn")
+    report = {}
+    for config_name in config_names:
+        rows = {}
+        names = strategies(VanillaVAE(**configs[config_name]))
+        for strategy, blocks in names.items():
+            results = context.SimpleQueue()
+            process = context.Process(
+                target=_spawned, args=(config_name, strategy, results)
+            )
+            process.start()
+            process.join()
+            if process.exitcode != 0 and results.empty():
+                # Killed (e.g. by the OOM killer) or crashed outside Python
+                row = {"error": f"exit code {process.exitcode}"}
+            else:
+                row = results.get()
+            rows[strategy] = dict(row, blocks=blocks)
+        base = rows["none"]
+        for row in rows.values():
+            if "error" in row or "error" in base:
+                continue
+            row["memory_saved"] = 1 - (
+                row["training_memory_bytes"] / base["training_memory_bytes"]
+            )
+            row["extra_step_time"] = row["step_time_s"] / base["step_time_s"] - 1
+        report[config_name] = rows
+    return report
+
+
+if __name__ == "__main__":
+    report = table()
+    print(f"batch_size {batch_size}")
+    print(
+        f"{'config':>10} {'strategy':>8} {'memory MiB':>11} {'saved':>7} "
+        f"{'step s':>7} {'extra time':>10}"
+    )
+    for config_name, rows in report.items():
+        for strategy, row in rows.items():
+            if "error" in row:
+                print(f"{config_name:>10} {strategy:>8} {row['error']}")
+                continue
+            # Without a baseline there is nothing to compare against
+            saved = row.get("memory_saved", float("nan"))
+            extra = row.get("extra_step_time", float("nan"))
+            print(
+                f"{config_name:>10} {strategy:>8} "
+                f"{row['training_memory_bytes'] / 2**20:>11.0f} "
+                f"{saved:>7.0%} {row['step_time_s']:>7.2f} "
+                f"{extra:>10.0%}"
+            )
+
+    os.makedirs(os.path.dirname(results_path), exist_ok=True)
+    with open(results_path, "w") as f:
+        json.dump({"batch_size": batch_size, "configs": report}, f, indent=2)
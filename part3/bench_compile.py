@@ -0,0 +1,146 @@
+import json
+import os
+import tempfile
+import time
+
+import torch
+from torch.optim import Adam
+
+from vae_compile import COMPILE_MODES, CompiledVAE
+from vae_model import VanillaVAE, configs
+
+# Eager vs TorchScript vs torch.compile for VanillaVAE on CPU.
+#
+# For every config and compile mode: time of the first training step (which
+# includes compilation) with an empty and with a warm compile cache, training
+# throughput, and encode / decode / sample latency in eval mode. Small batch
+# sizes are where Python dispatch overhead dominates.
+#
+# Every mode first runs one training step (forward and backward) under bf16
+# autocast, as with use_bf16 in the training scripts; a mode that fails or
+# whose loss or gradients differ from eager by more than bf16_rtol raises.
+
+config_names = ["celeba64", "celeba128", "mnist"]
+batch_sizes = [8, 64]
+warmup_steps = 2
+timed_steps = 10
+kld_weight = 0.00025
+bf16_rtol = 1e-2
+results_path = "./results/compile_report.json"
+
+
+def mean_time(fn, *args) -> float:
+    for _ in range(warmup_steps):
+        fn(*args)
+    start = time.perf_counter()
+    for _ in range(timed_steps):
+        fn(*args)
+    return (time.perf_counter() - start) / timed_steps
+
+
+def autocast_step(config_name: str, mode: str, cache_dir: str):
+    """Loss and gradient norm of one bf16 autocast training step."""
+    config = configs[config_name]
+    torch.manual_seed(42)
+    model = VanillaVAE(**config)
+    compiled = CompiledVAE(model, mode, cache_dir)
+    images = torch.rand(
+        batch_sizes[0], config["in_channels"], *[config["img_size"]] * 2
+    )
+    with torch.autocast("cpu", dtype=torch.bfloat16):
+        outputs = compiled(images)
+    outputs = [output.float() for output in outputs]
+    loss = model.loss_function(*outputs, M_N=kld_weight)["loss"]
+    loss.backward()
+    grads = torch.cat([p.grad.flatten() for p in model.parameters()])
+    return loss.item(), grads.norm().item()
+
+
+def check_autocast(config_name: str, mode: str, cache_dir: str) -> None:
+    try:
+        result = autocast_step(config_name, mode, cache_dir)
+    except Exception as error:
+        raise RuntimeError(
+            f"{config_name} {mode}: bf16 training step failed"
+        ) from error
+    expected = autocast_step(config_name, "eager", cache_dir)
+    for name, value, reference in zip(("loss", "gradient norm"), result, expected):
+        if abs(value - reference) > bf16_rtol * abs(reference):
+            raise ValueError(
+                f"{config_name} {mode}: bf16 {name} {value:.4g}, eager {reference:.4g}"
+            )
+
+
+def bench(config_name: str, mode: str, cache_dir: str) -> dict:
+    config = configs[config_name]
+    shape = (config["in_channels"], config["img_size"], config["img_size"])
+    torch.manual_seed(42)
+    model = VanillaVAE(**config)
+    optimizer = Adam(model.parameters(), lr=0.005)
+
+    def train_step(compiled, images):
+        optimizer.zero_grad()
+        loss = model.loss_function(*compiled(images), M_N=kld_weight)["loss"]
+        loss.backward()
+        optimizer.step()
+
+    result = {}
+    images = torch.rand(batch_sizes[0], *shape)
+    for start_kind in ("cold", "warm"):
+        # warm: in-process graphs dropped, on-disk compile cache kept
+        torch._dynamo.reset()
+        compiled = CompiledVAE(model, mode, cache_dir)
+        start = time.perf_counter()
+        train_step(compiled, images)
+        result[f"first_step_{start_kind}_s"] = time.perf_counter() - start
+
+    for batch_size in batch_sizes:
+        images = torch.rand(batch_size, *shape)
+        z = torch.randn(batch_size, config["latent_dim"])
+        row = {}
+        model.train()
+        row["train_images_per_sec"] = batch_size / mean_time(
+            train_step, compiled, images
+        )
+        model.eval()
+        with torch.no_grad():
+            row["encode_ms"] = 1000 * mean_time(compiled.encode, images)
+            row["decode_ms"] = 1000 * mean_time(compiled.decode, z)
+            row["sample_ms"] = 1000 * mean_time(compiled.sample, batch_size, "cpu")
+        result[f"batch_{batch_size}"] = row
+    return result
+
+
+if __name__ == "__main__":
+    report = {"threads": torch.get_num_threads(), "configs": {}}
+    for config_name in config_names:
+        rows = {}
+        for mode in COMPILE_MODES:
+            # Fresh cache per run so "cold" really starts from nothing
+            with tempfile.TemporaryDirectory() as cache_dir:
+                check_autocast(config_name, mode, cache_dir)
+                rows[mode] = bench(config_name, mode, cache_dir)
+        report["configs"][config_name] = rows
+
+        print(config_name)
+        print(
+            f"{'mode':>8} {'batch':>6} {'train img/s':>12} {'encode ms':>10} "
+            f"{'decode ms':>10} {'sample ms':>10}"
+        )
+        for mode, result in rows.items():
+            for batch_size in batch_sizes:
+                row = result[f"batch_{batch_size}"]
+                print(
+                    f"{mode:>8} {batch_size:>6} {row['train_images_per_sec']:>12.1f} "
+                    f"{row['encode_ms']:>10.2f} {row['decode_ms']:>10.2f} "
+                    f"{row['sample_ms']:>10.2f}"
+                )
+        for mode, result in rows.items():
+            print(
+                f"{mode:>8} first step: {result['first_step_cold_s']:.2f} s cold, "
+                f"{result['first_step_warm_s']:.2f} s warm cache"
+            )
+
+    os.makedirs(os.path.dirname(results_path), exist_ok=True)
+    with open(results_path, "w") as f:
+        json.dump(report, f, indent=2)
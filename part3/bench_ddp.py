@@ -0,0 +1,153 @@
+import json
+import os
+import socket
+import time
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+from torch.optim import Adam
+
+from vae_model import VanillaVAE, configs
+
+# Data-parallel scaling benchmark for VanillaVAE on CPU (gloo).
+#
+# Run directly to spawn 1, 2, 4, ... local processes on this machine, or under
+# torchrun to measure one multi-node configuration:
+#
+#   python bench_ddp.py
+#   torchrun --nnodes=2 --node_rank=0 --nproc_per_node=4 \
+#       --master_addr=node0 --master_port=29500 bench_ddp.py
+#
+# Steps use synthetic images so the numbers measure compute and gradient
+# all-reduce only. With scaling = "weak" every rank keeps batch_size images,
+# as the training scripts do; with "strong" the global batch is split.
+
+config_name = "celeba64"
+batch_size = 256
+scaling = "weak"  # "weak" or "strong"
+warmup_steps = 3
+timed_steps = 10
+kld_weight = 0.00025
+results_path = "./results/ddp_scaling.json"
+
+
+def run_steps(rank: int, world_size: int, num_threads: int) -> float:
+    torch.set_num_threads(num_threads)
+    torch.manual_seed(42)
+
+    config = configs[config_name]
+    img_size = config["img_size"]
+    model = VanillaVAE(**config)
+    train_model = DistributedDataParallel(model) if world_size > 1 else model
+    optimizer = Adam(model.parameters(), lr=0.005)
+
+    local_batch = batch_size if scaling == "weak" else batch_size // world_size
+    images = torch.rand(local_batch, config["in_channels"], img_size, img_size)
+
+    def step():
+        optimizer.zero_grad()
+        outputs = train_model(images)
+        loss = model.loss_function(*outputs, M_N=kld_weight)["loss"]
+        loss.backward()
+        optimizer.step()
+
+    for _ in range(warmup_steps):
+        step()
+    if world_size > 1:
+        dist.barrier()
+    start = time.perf_counter()
+    for _ in range(timed_steps):
+        step()
+    if world_size > 1:
+        dist.barrier()
+    elapsed = time.perf_counter() - start
+    return local_batch * world_size * timed_steps / elapsed
+
+
+def _spawned(rank: int, world_size: int, port: int, num_threads: int, results):
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(port)
+    if world_size > 1:
+        dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    images_per_sec = run_steps(rank, world_size, num_threads)
+    if rank == 0:
+        results.put(images_per_sec)
+    if world_size > 1:
+        dist.destroy_process_group()
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def local_scaling(world_sizes) -> list:
+    cores = os.cpu_count() or 1
+    context = mp.get_context("spawn")
+    rows = []
+    for world_size in world_sizes:
+        num_threads = max(1, cores // world_size)
+        results = context.SimpleQueue()
+        mp.spawn(
+            _spawned,
+            args=(world_size, _free_port(), num_threads, results),
+            nprocs=world_size,
+        )
+        rows.append(
+            {
+                "world_size": world_size,
+                "threads_per_rank": num_threads,
+                "images_per_sec": results.get(),
+            }
+        )
+    return rows
+
+
+def report(rows: list) -> None:
+    baseline = rows[0]["images_per_sec"] / rows[0]["world_size"]
+    print(f"{config_name}, batch_size {batch_size}, {scaling} scaling")
+    print(f"{'ranks':>6} {'threads':>8} {'img/s':>10} {'speedup':>8} {'eff.':>6}")
+    for row in rows:
+        speedup = row["images_per_sec"] / baseline
+        row["speedup"] = speedup
+        row["efficiency"] = speedup / row["world_size"]
+        print(
+            f"{row['world_size']:>6} {row['threads_per_rank']:>8} "
+            f"{row['images_per_sec']:>10.1f} {speedup:>8.2f} {row['efficiency']:>6.2f}"
+        )
+
+    os.makedirs(os.path.dirname(results_path), exist_ok=True)
+    with open(results_path, "w") as f:
+        json.dump(
+            {
+                "host": socket.gethostname(),
+                "config": config_name,
+                "batch_size": batch_size,
+                "scaling": scaling,
+                "rows": rows,
+            },
+            f,
+            indent=2,
+        )
+
+
+if __name__ == "__main__":
+    if "RANK" in os.environ:
+        # Launched by torchrun: one configuration, possibly across nodes
+        dist.init_process_group("gloo")
+        local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", 1))
+        num_threads = max(1, (os.cpu_count() or 1) // local_world_size)
+        images_per_sec = run_steps(dist.get_rank(), dist.get_world_size(), num_threads)
+        if dist.get_rank() == 0:
+            print(
+                f"{config_name}: {dist.get_world_size()} ranks, "
+                f"{num_threads} threads/rank, {images_per_sec:.1f} img/s"
+            )
+        dist.destroy_process_group()
+    else:
+        cores = os.cpu_count() or 1
+        world_sizes = [n for n in (1, 2, 4, 8, 16, 32) if n <= cores] or [1]
+        report(local_scaling(world_sizes))
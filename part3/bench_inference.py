@@ -0,0 +1,89 @@
+import json
+import os
+import time
+
+import torch
+
+from vae_model import VanillaVAE, configs
+
+# Eval-mode VanillaVAE vs its inference_copy() (BatchNorm folded, channels-last).
+#
+# BatchNorm statistics are first populated with a few training-mode passes, so
+# folding is not a no-op. For encode, decode and sample the report gives the
+# largest absolute difference to the eval-mode model and both latencies; it
+# raises ValueError when a difference exceeds atol.
+
+config_names = ["celeba64", "celeba128", "mnist"]
+batch_size = 16
+warmup_steps = 2
+timed_steps = 20
+atol = 1e-4
+results_path = "./results/inference_report.json"
+
+
+def mean_time(fn, *args) -> float:
+    for _ in range(warmup_steps):
+        fn(*args)
+    start = time.perf_counter()
+    for _ in range(timed_steps):
+        fn(*args)
+    return (time.perf_counter() - start) / timed_steps
+
+
+def compare(config_name: str) -> dict:
+    config = configs[config_name]
+    shape = (batch_size, config["in_channels"], config["img_size"], config["img_size"])
+    torch.manual_seed(42)
+    model = VanillaVAE(**config)
+    with torch.no_grad():
+        for _ in range(5):
+            model(torch.rand(shape))
+    model.eval()
+    fused = model.inference_copy()
+
+    images = torch.rand(shape)
+    z = torch.randn(batch_size, config["latent_dim"])
+
+    def sample(vae):
+        torch.manual_seed(0)
+        return vae.sample(batch_size, "cpu")
+
+    calls = {
+        "encode": lambda vae: torch.cat(vae.encode(images), dim=1),
+        "decode": lambda vae: vae.decode(z),
+        "sample": sample,
+    }
+    report = {}
+    with torch.no_grad():
+        for name, call in calls.items():
+            error = (call(model) - call(fused)).abs().max().item()
+            if error > atol:
+                raise ValueError(
+                    f"{config_name} {name}: inference copy differs by {error:.2e}"
+                )
+            eager_ms = 1000 * mean_time(call, model)
+            fused_ms = 1000 * mean_time(call, fused)
+            report[name] = {
+                "max_abs_error": error,
+                "eval_ms": eager_ms,
+                "inference_copy_ms": fused_ms,
+                "speedup": eager_ms / fused_ms,
+            }
+    return report
+
+
+if __name__ == "__main__":
+    results = {"batch_size": batch_size, "configs": {}}
+    for config_name in config_names:
+        report = compare(config_name)
+        results["configs"][config_name] = report
+        print(f"{config_name} (batch_size {batch_size})")
+        for name, row in report.items():
+            print(
+                f"  {name}: {row['eval_ms']:8.2f} ms -> {row['inference_copy_ms']:8.2f} ms "
+                f"(x{row['speedup']:.2f}), max abs error {row['max_abs_error']:.1e}"
+            )
+
+    os.makedirs(os.path.dirname(results_path), exist_ok=True)
+    with open(results_path, "w") as f:
+        json.dump(results, f, indent=2)
@@ -0,0 +1,133 @@
+import json
+import os
+import time
+
+import torch
+from torch.optim import Adam
+
+from celeba_cache import CelebACache
+from vae_model import VanillaVAE, configs
+
+# fp32 vs bfloat16 autocast comparison for the training step on CPU.
+#
+# Both runs start from the same weights and see the same batches. The report
+# gives training throughput, the loss reached after num_steps (mean of the last
+# 10 steps and on held-out batches, always computed in fp32) and the bytes of
+# activations kept for backward, which bounds how far batch_size can grow at a
+# fixed memory budget. Uses the cached CelebA split when cache_dir exists,
+# synthetic images otherwise.
+
+config_names = ["celeba64", "celeba128"]
+cache_dir = "../../data/celeba/cache"
+batch_size = 64
+num_steps = 50
+warmup_steps = 3
+eval_batches = 4
+learning_rate = 0.005
+kld_weight = 0.00025
+results_path = "./results/precision_report.json"
+
+
+def load_batches(img_size: int, count: int, split: str):
+    if os.path.exists(cache_dir):
+        dataset = CelebACache(cache_dir, img_size, split=split)
+        generator = torch.Generator().manual_seed(0 if split == "train" else 1)
+        batches = []
+        for _ in range(count):
+            indices = torch.randint(len(dataset), (batch_size,), generator=generator)
+            images, _ = dataset.__getitems__(indices.tolist())
+            batches.append(images.float().div_(255))
+        return batches, "celeba"
+    generator = torch.Generator().manual_seed(0 if split == "train" else 1)
+    shape = (batch_size, 3, img_size, img_size)
+    return [torch.rand(shape, generator=generator) for _ in range(count)], "synthetic"
+
+
+def activation_bytes(model, images: torch.Tensor, use_bf16: bool) -> int:
+    """Bytes of tensors autograd saves for backward in one forward pass."""
+    seen = {}
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        seen[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        with torch.autocast("cpu", dtype=torch.bfloat16, enabled=use_bf16):
+            outputs = model(images)
+        outputs = [output.float() for output in outputs]
+        model.loss_function(*outputs, M_N=kld_weight)["loss"].backward()
+    model.zero_grad()
+    return sum(seen.values())
+
+
+def run(config_name: str, use_bf16: bool, train_batches, eval_images) -> dict:
+    torch.manual_seed(42)
+    model = VanillaVAE(**configs[config_name])
+    optimizer = Adam(model.parameters(), lr=learning_rate)
+
+    memory = activation_bytes(model, train_batches[0], use_bf16)
+
+    losses = []
+    for step, images in enumerate(train_batches):
+        if step == warmup_steps:
+            start = time.perf_counter()
+        optimizer.zero_grad()
+        with torch.autocast("cpu", dtype=torch.bfloat16, enabled=use_bf16):
+            outputs = model(images)
+        outputs = [output.float() for output in outputs]
+        loss = model.loss_function(*outputs, M_N=kld_weight)["loss"]
+        loss.backward()
+        optimizer.step()
+        losses.append(loss.item())
+    elapsed = time.perf_counter() - start
+
+    model.eval()
+    eval_loss = 0.0
+    with torch.no_grad():
+        for images in eval_images:
+            outputs = model(images)
+            eval_loss += model.loss_function(*outputs, M_N=kld_weight)["loss"].item()
+
+    return {
+        "images_per_sec": batch_size * (len(train_batches) - warmup_steps) / elapsed,
+        "final_train_loss": sum(losses[-10:]) / len(losses[-10:]),
+        "eval_loss": eval_loss / len(eval_images),
+        "activation_bytes": memory,
+    }
+
+
+if __name__ == "__main__":
+    report = {"batch_size": batch_size, "num_steps": num_steps, "configs": {}}
+    for config_name in config_names:
+        img_size = configs[config_name]["img_size"]
+        train_batches, data = load_batches(img_size, num_steps, "train")
+        eval_images, _ = load_batches(img_size, eval_batches, "val")
+        fp32 = run(config_name, False, train_batches, eval_images)
+        bf16 = run(config_name, True, train_batches, eval_images)
+        memory_ratio = bf16["activation_bytes"] / fp32["activation_bytes"]
+        report["configs"][config_name] = {
+            "data": data,
+            "fp32": fp32,
+            "bf16": bf16,
+            "speedup": bf16["images_per_sec"] / fp32["images_per_sec"],
+            "activation_ratio": memory_ratio,
+            "max_batch_size_same_memory": int(batch_size / memory_ratio),
+        }
+
+        print(f"{config_name} ({data}, batch_size {batch_size}, {num_steps} steps)")
+        for name, result in (("fp32", fp32), ("bf16", bf16)):
+            print(
+                f"  {name}: {result['images_per_sec']:8.1f} img/s, "
+                f"train loss {result['final_train_loss']:.4f}, "
+                f"eval loss {result['eval_loss']:.4f}, "
+                f"activations {result['activation_bytes'] / 2**20:7.1f} MiB"
+            )
+        print(
+            f"  bf16 speedup x{report['configs'][config_name]['speedup']:.2f}, "
+            f"activation memory x{memory_ratio:.2f}"
+        )
+
+    os.makedirs(os.path.dirname(results_path), exist_ok=True)
+    with open(results_path, "w") as f:
+        json.dump(report, f, indent=2)
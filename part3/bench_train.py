@@ -0,0 +1,229 @@
+import json
+import os
+import platform
+import resource
+import socket
+import subprocess
+import time
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from torch.optim import Adam
+from torchvision import transforms
+
+from celeba_cache import CelebACache
+from loaders import BackgroundPrefetcher, ResumableSampler, make_loader
+from shards import ShardStream
+from vae_compile import CompiledVAE
+from vae_model import VanillaVAE, configs
+
+# Training throughput benchmark for the shipped VanillaVAE configs.
+#
+# Every (config, data, threads) combination runs a fixed window of training
+# steps in a fresh process, so peak RSS is per run. "synthetic" feeds random
+# tensors and measures the model alone; "real" reads the CelebA cache
+# (celeba_cache.py) or the MNIST shards (shards.py) through the same loader
+# stack as the training scripts, so data loading shows up in the step times.
+# Step time is measured from the end of one optimizer step to the end of the
+# next, including the wait for the batch.
+#
+# Each run writes a JSON file named after host, code revision and thread
+# counts into results_dir, so files from different machines and revisions
+# can be compared side by side.
+
+config_names = ["celeba64", "celeba128", "mnist"]
+data_modes = ["synthetic", "real"]
+thread_counts = [os.cpu_count() or 1]
+batch_size = 256
+warmup_steps = 5
+timed_steps = 50
+num_workers = 4
+use_bf16 = False
+compile_mode = "eager"
+kld_weight = 0.00025
+celeba_cache_dir = "../../data/celeba/cache"  # written by celeba_cache.py
+mnist_shards_dir = "./data/MNIST/shards"  # written by shards.py
+results_dir = "./results/benchmarks/"
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def worker_peak_rss() -> int:
+    """Summed peak RSS (VmHWM) of the live child processes, the loader workers."""
+    total = 0
+    for task in os.listdir("/proc/self/task"):
+        with open(f"/proc/self/task/{task}/children") as f:
+            pids = f.read().split()
+        for pid in pids:
+            try:
+                with open(f"/proc/{pid}/status") as f:
+                    for line in f:
+                        if line.startswith("VmHWM:"):
+                            total += int(line.split()[1]) * 1024
+            except FileNotFoundError:
+                pass  # exited in the meantime
+    return total
+
+
+def real_batches(config_name: str):
+    """Endless stream of training batches from the cached or sharded dataset."""
+    img_size = configs[config_name]["img_size"]
+    if config_name == "mnist":
+        transform = transforms.Compose(
+            [transforms.Resize((img_size, img_size)), transforms.ToTensor()]
+        )
+        dataset = ShardStream(mnist_shards_dir, "train", transform, shuffle=True)
+        sampler, collate_fn = None, None
+    else:
+        dataset = CelebACache(celeba_cache_dir, img_size, split="train")
+        sampler, collate_fn = ResumableSampler(len(dataset)), CelebACache.collate
+    loader = BackgroundPrefetcher(
+        make_loader(
+            dataset,
+            batch_size=batch_size,
+            sampler=sampler,
+            num_workers=num_workers,
+            collate_fn=collate_fn,
+            drop_last=True,
+        )
+    )
+    epoch = 0
+    while True:
+        (sampler or dataset).set_epoch(epoch)
+        for images, _ in loader:
+            yield images
+        epoch += 1
+
+
+def synthetic_batches(config_name: str):
+    config = configs[config_name]
+    shape = (batch_size, config["in_channels"], config["img_size"], config["img_size"])
+    images = torch.rand(shape)
+    while True:
+        yield images
+
+
+def run_window(config_name: str, data_mode: str, num_threads: int) -> dict:
+    torch.set_num_threads(num_threads)
+    torch.manual_seed(42)
+    model = VanillaVAE(**configs[config_name])
+    optimizer = Adam(model.parameters(), lr=0.005)
+    train_model = CompiledVAE(model, compile_mode)
+    if data_mode == "real":
+        batches = real_batches(config_name)
+    else:
+        batches = synthetic_batches(config_name)
+
+    step_times = []
+    last = time.perf_counter()
+    for step in range(warmup_steps + timed_steps):
+        images = next(batches)
+        optimizer.zero_grad()
+        with torch.autocast("cpu", dtype=torch.bfloat16, enabled=use_bf16):
+            outputs = train_model(images)
+        outputs = [output.float() for output in outputs]
+        loss = model.loss_function(*outputs, M_N=kld_weight)["loss"]
+        loss.backward()
+        optimizer.step()
+        now = time.perf_counter()
+        if step >= warmup_steps:
+            step_times.append(now - last)
+        last = now
+
+    step_times = np.array(step_times)
+    # ru_maxrss is in KiB on Linux. RUSAGE_CHILDREN would only count exited
+    # children, the persistent loader workers are still running here
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    peak_worker_rss = worker_peak_rss()
+    return {
+        "config": config_name,
+        "data": data_mode,
+        "threads": num_threads,
+        "images_per_sec": batch_size * len(step_times) / step_times.sum(),
+        "step_time_ms": {
+            f"p{q}": 1000 * float(np.percentile(step_times, q)) for q in (50, 90, 99)
+        },
+        "peak_rss_bytes": peak_rss,
+        "peak_worker_rss_bytes": peak_worker_rss,
+    }
+
+
+def _spawned(config_name: str, data_mode: str, num_threads: int, results) -> None:
+    try:
+        results.put(run_window(config_name, data_mode, num_threads))
+    except Exception as error:
+        results.put({"config": config_name, "data": data_mode, "error": repr(error)})
+
+
+def benchmark() -> dict:
+    context = mp.get_context("spawn")
+    rows = []
+    for config_name in config_names:
+        for data_mode in data_modes:
+            for num_threads in thread_counts:
+                results = context.SimpleQueue()
+                process = context.Process(
+                    target=_spawned, args=(config_name, data_mode, num_threads, results)
+                )
+                process.start()
+                process.join()
+                if process.exitcode != 0 and results.empty():
+                    # Killed (e.g. by the OOM killer) or crashed outside Python
+                    error = f"exit code {process.exitcode}"
+                    rows.append(
+                        {"config": config_name, "data": data_mode, "error": error}
+                    )
+                else:
+                    rows.append(results.get())
+    return {
+        "host": socket.gethostname(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "torch": torch.__version__,
+        "revision": git_revision(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "batch_size": batch_size,
+        "timed_steps": timed_steps,
+        "num_workers": num_workers,
+        "use_bf16": use_bf16,
+        "compile_mode": compile_mode,
+        "rows": rows,
+    }
+
+
+if __name__ == "__main__":
+    report = benchmark()
+    print(f"{report['host']} @ {report['revision']}, batch_size {batch_size}")
+    print(
+        f"{'config':>10} {'data':>10} {'threads':>8} {'img/s':>9} "
+        f"{'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'RSS MiB':>8}"
+    )
+    for row in report["rows"]:
+        if "error" in row:
+            print(f"{row['config']:>10} {row['data']:>10}  skipped: {row['error']}")
+            continue
+        times = row["step_time_ms"]
+        print(
+            f"{row['config']:>10} {row['data']:>10} {row['threads']:>8} "
+            f"{row['images_per_sec']:>9.1f} {times['p50']:>8.1f} "
+            f"{times['p90']:>8.1f} {times['p99']:>8.1f} "
+            f"{row['peak_rss_bytes'] / 2**20:>8.0f}"
+        )
+
+    os.makedirs(results_dir, exist_ok=True)
+    threads = "-".join(str(n) for n in thread_counts)
+    name = f"train_{report['host']}_{report['revision']}_{threads}t.json"
+    with open(os.path.join(results_dir, name), "w") as f:
+        json.dump(report, f, indent=2)
@@ -0,0 +1,172 @@
+import json
+import os
+from typing import List, Tuple
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset, Subset, random_split
+from torchvision import datasets, transforms
+from tqdm import tqdm
+
+from decoders import get_loader
+
+# A cache is two files in cache_dir:
+#   celeba_{img_size}.u8    raw uint8 array of shape (N, 3, img_size, img_size)
+#   celeba_{img_size}.json  sidecar index (shape, split sizes, source indices, labels)
+# Rows are written in split order (train first, then val) so that sequential
+# reads of the validation set are contiguous slices of the memory map.
+
+
+def cache_paths(cache_dir: str, img_size: int) -> Tuple[str, str]:
+    stem = os.path.join(cache_dir, f"celeba_{img_size}")
+    return stem + ".u8", stem + ".json"
+
+
+def split_indices(num_samples: int, val_fraction: float = 0.1, seed: int = 42):
+    # Same split as random_split in the training scripts after torch.manual_seed(42)
+    train_size = int((1 - val_fraction) * num_samples)
+    val_size = num_samples - train_size
+    train_split, val_split = random_split(
+        range(num_samples),
+        [train_size, val_size],
+        generator=torch.Generator().manual_seed(seed),
+    )
+    return list(train_split.indices), list(val_split.indices)
+
+
+def build_cache(
+    data_dir: str,
+    cache_dir: str,
+    img_size: int,
+    val_fraction: float = 0.1,
+    seed: int = 42,
+    batch_size: int = 256,
+    num_workers: int = 8,
+    decode_backend: str = "pil",
+) -> str:
+    """Decode and resize every image once and write them to a uint8 memory map."""
+    os.makedirs(cache_dir, exist_ok=True)
+    data_path, index_path = cache_paths(cache_dir, img_size)
+
+    transform = transforms.Compose(
+        [
+            transforms.Resize((img_size, img_size)),
+            transforms.PILToTensor(),
+        ]
+    )
+    dataset = datasets.ImageFolder(
+        root=data_dir,
+        transform=transform,
+        loader=get_loader(decode_backend, img_size),
+    )
+
+    train_indices, val_indices = split_indices(len(dataset), val_fraction, seed)
+    order = train_indices + val_indices
+
+    shape = (len(order), 3, img_size, img_size)
+    images = np.memmap(data_path + ".tmp", dtype=np.uint8, mode="w+", shape=shape)
+    labels: List[int] = []
+
+    source_loader = DataLoader(
+        Subset(dataset, order),
+        batch_size=batch_size,
+        shuffle=False,
+        num_workers=num_workers,
+    )
+    row = 0
+    for batch_images, batch_labels in tqdm(source_loader, desc=f"Caching {img_size}px"):
+        images[row : row + len(batch_images)] = batch_images.numpy()
+        labels.extend(batch_labels.tolist())
+        row += len(batch_images)
+    images.flush()
+    del images
+
+    index = {
+        "img_size": img_size,
+        "shape": list(shape),
+        "dtype": "uint8",
+        "data_file": os.path.basename(data_path),
+        "train_size": len(train_indices),
+        "val_size": len(val_indices),
+        "seed": seed,
+        "source_indices": order,
+        "files": [os.path.relpath(dataset.samples[i][0], data_dir) for i in order],
+        "labels": labels,
+    }
+    os.replace(data_path + ".tmp", data_path)
+    with open(index_path + ".tmp", "w") as f:
+        json.dump(index, f)
+    os.replace(index_path + ".tmp", index_path)
+    return index_path
+
+
+class CelebACache(Dataset):
+    """Map-style dataset over a cache written by build_cache.
+
+    Items are uint8 tensors viewing the memory map. The DataLoader fetches whole
+    batches through __getitems__, so images are only converted to float once per
+    batch in collate().
+    """
+
+    def __init__(self, cache_dir: str, img_size: int, split: str = "train") -> None:
+        super().__init__()
+        data_path, index_path = cache_paths(cache_dir, img_size)
+        with open(index_path) as f:
+            self.index = json.load(f)
+
+        # Copy-on-write mapping: pages are shared with the page cache and
+        # torch.from_numpy does not complain about a read-only buffer
+        self.images = np.memmap(
+            data_path, dtype=np.uint8, mode="c", shape=tuple(self.index["shape"])
+        )
+        self.labels = np.asarray(self.index["labels"], dtype=np.int64)
+
+        train_size = self.index["train_size"]
+        if split == "train":
+            self.start, self.stop = 0, train_size
+        elif split == "val":
+            self.start, self.stop = train_size, len(self.labels)
+        elif split == "all":
+            self.start, self.stop = 0, len(self.labels)
+        else:
+            raise ValueError(f"Unknown split: {split}")
+
+    def __len__(self) -> int:
+        return self.stop - self.start
+
+    def __getitem__(self, idx: int):
+        row = self.start + idx
+        return torch.from_numpy(self.images[row]), int(self.labels[row])
+
+    def __getitems__(self, indices: List[int]):
+        rows = np.asarray(indices, dtype=np.int64) + self.start
+        first, last = int(rows[0]), int(rows[-1])
+        if last - first + 1 == len(rows) and np.all(np.diff(rows) == 1):
+            # Contiguous run (e.g. the unshuffled validation loader): zero-copy slice
+            images = self.images[first : last + 1]
+            labels = self.labels[first : last + 1]
+        else:
+            # Sorting keeps the gather sequential on disk; order within a batch
+            # does not matter for training
+            rows.sort()
+            images = self.images[rows]
+            labels = self.labels[rows]
+        return torch.from_numpy(images), torch.from_numpy(labels)
+
+    @staticmethod
+    def collate(batch):
+        images, labels = batch
+        return images.float().div_(255), labels
+
+    @staticmethod
+    def collate_raw(batch):
+        # Keep uint8 for batch_transforms.BatchTransform in the main process
+        return batch
+
+
+if __name__ == "__main__":
+    data_dir = "../../data/celeba/img_align_celeba"
+    cache_dir = "../../data/celeba/cache"
+
+    for img_size in (64, 128):
+        print(build_cache(data_dir, cache_dir, img_size))
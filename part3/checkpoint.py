@@ -0,0 +1,129 @@
+import copy
+import os
+import random
+import threading
+from typing import Optional
+
+import numpy as np
+import torch
+
+# Full training checkpoints hold everything needed to continue a run exactly:
+# model, optimizer and scheduler state, RNG state, the dataset split and the
+# position inside the current epoch. They are written from a CPU snapshot on a
+# background thread, so the training step only pays for the snapshot copy.
+
+
+def snapshot(obj):
+    """Deep copy of a (nested) state dict with every tensor cloned to CPU."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {key: snapshot(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(value) for value in obj)
+    return copy.deepcopy(obj)
+
+
+def capture_rng_state() -> dict:
+    return {
+        "torch": torch.get_rng_state(),
+        "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+        "numpy": np.random.get_state(),
+        "python": random.getstate(),
+    }
+
+
+def restore_rng_state(state: dict) -> None:
+    torch.set_rng_state(state["torch"])
+    if state["cuda"] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+    np.random.set_state(state["numpy"])
+    random.setstate(state["python"])
+
+
+def training_state(model, optimizer, scheduler, epoch: int, step: int, **extra) -> dict:
+    """Everything needed to resume at batch step of epoch (step 0: epoch start)."""
+    state = {
+        "model": model.state_dict(),
+        "optimizer": optimizer.state_dict(),
+        "scheduler": scheduler.state_dict(),
+        "epoch": epoch,
+        "step": step,
+        "rng": capture_rng_state(),
+    }
+    state.update(extra)
+    return state
+
+
+def load_checkpoint(path: str) -> Optional[dict]:
+    if not os.path.exists(path):
+        return None
+    return torch.load(path, map_location="cpu")
+
+
+def _write(state, path: str) -> None:
+    # Write then rename, so a crash mid-write never leaves a truncated checkpoint
+    torch.save(state, path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+
+class AsyncCheckpointer:
+    """Saves snapshots on a background thread.
+
+    If a save is requested while an older snapshot for the same path is still
+    queued, only the newer one is written.
+    """
+
+    def __init__(self) -> None:
+        self._pending = {}
+        self._condition = threading.Condition()
+        self._writing = False
+        self._closed = False
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def save(self, state, path: str) -> None:
+        copied = snapshot(state)
+        with self._condition:
+            self._raise_error()
+            self._pending[path] = copied
+            self._condition.notify_all()
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+                if not self._pending:
+                    return
+                path = next(iter(self._pending))
+                state = self._pending.pop(path)
+                self._writing = True
+            try:
+                _write(state, path)
+            except Exception as error:
+                with self._condition:
+                    self._error = error
+            with self._condition:
+                self._writing = False
+                self._condition.notify_all()
+
+    def _raise_error(self) -> None:
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def wait(self) -> None:
+        """Block until every queued snapshot is on disk."""
+        with self._condition:
+            while self._pending or self._writing:
+                self._condition.wait()
+            self._raise_error()
+
+    def close(self) -> None:
+        self.wait()
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
@@ -0,0 +1,173 @@
+import copy
+import itertools
+import math
+import time
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+import torch
+from torch.optim import Adam
+
+# Time-to-target control of a training run, in three parts:
+#
+#   lr_range_test      before a new run: train a copy of the model for a few
+#                      dozen steps while the learning rate grows exponentially
+#                      from min_lr to max_lr, and suggest the rate where the
+#                      smoothed loss falls fastest (capped a decade below its
+#                      minimum).
+#   lr_schedule        "plateau" in the training scripts: ReduceLROnPlateau on
+#                      the validation loss instead of a fixed ExponentialLR.
+#   TrainingController stops the run once the validation ELBO reaches a
+#                      target, after patience epochs without improvement, or
+#                      before the next epoch would exceed a time budget, and
+#                      reports why and how many epochs (and roughly how much
+#                      time) that saved compared to running all num_epochs.
+
+
+def lr_range_test(
+    model: torch.nn.Module,
+    batches: Iterable[torch.Tensor],
+    kld_weight: float,
+    micro_batch_size: Optional[int] = None,
+    min_lr: float = 1e-6,
+    max_lr: float = 1.0,
+    num_steps: int = 100,
+    smoothing: float = 0.98,
+    diverge: float = 4.0,
+) -> Tuple[float, List[Tuple[float, float]]]:
+    """Suggested learning rate and the (lr, smoothed loss) curve it came from.
+
+    model is left untouched. The test stops early once the smoothed loss is
+    diverge times its best value.
+    """
+    model = copy.deepcopy(model).train()
+    optimizer = Adam(model.parameters(), lr=min_lr)
+    growth = (max_lr / min_lr) ** (1 / (num_steps - 1))
+    curve = []
+    average, best = 0.0, math.inf
+    for i, images in enumerate(itertools.islice(batches, num_steps)):
+        lr = min_lr * growth**i
+        for group in optimizer.param_groups:
+            group["lr"] = lr
+        optimizer.zero_grad()
+        loss = 0.0
+        for micro_images in images.split(micro_batch_size or len(images)):
+            outputs = model(micro_images)
+            micro_loss = model.loss_function(*outputs, M_N=kld_weight)["loss"]
+            micro_loss = micro_loss * (len(micro_images) / len(images))
+            micro_loss.backward()
+            loss += micro_loss.item()
+        optimizer.step()
+
+        # Bias-corrected exponential moving average, as in Adam
+        average = smoothing * average + (1 - smoothing) * loss
+        smoothed = average / (1 - smoothing ** (i + 1))
+        if not math.isfinite(smoothed) or smoothed > diverge * best:
+            break
+        best = min(best, smoothed)
+        curve.append((lr, smoothed))
+
+    if len(curve) < 3:
+        raise RuntimeError("LR range test diverged at once, lower min_lr")
+    lrs, losses = np.array(curve).T
+    # Steepest descent of the loss against log(lr), but at least a decade
+    # below the minimum, where the loss is about to blow up
+    steepest = lrs[int(np.argmin(np.gradient(losses, np.log(lrs))))]
+    return float(min(steepest, lrs[int(np.argmin(losses))] / 10)), curve
+
+
+class TrainingController:
+    """Decides at the end of each epoch whether the run should stop early."""
+
+    def __init__(
+        self,
+        num_epochs: int,
+        target_elbo: Optional[float] = None,
+        time_budget: Optional[float] = None,
+        patience: Optional[int] = None,
+        min_delta: float = 0.0,
+    ) -> None:
+        self.num_epochs = num_epochs
+        self.target_elbo = target_elbo
+        self.time_budget = time_budget  # seconds of training, across resumes
+        self.patience = patience
+        self.min_delta = min_delta
+        self.seconds = 0.0
+        self.epochs = 0  # epochs timed so far
+        self.best = math.inf
+        self.bad_epochs = 0
+        self.stop_reason = None
+        self._epoch_start = None
+
+    def start_epoch(self) -> None:
+        self._epoch_start = time.perf_counter()
+
+    def _elapsed(self) -> float:
+        if self._epoch_start is None:
+            return self.seconds
+        return self.seconds + time.perf_counter() - self._epoch_start
+
+    def end_epoch(
+        self, epoch: int, val_loss: Optional[float], elbo: Optional[float]
+    ) -> Optional[str]:
+        """Reason to stop after epoch (0-based), or None to go on.
+
+        val_loss and elbo are None for epochs without validation.
+        """
+        self.seconds = self._elapsed()
+        self._epoch_start = None
+        self.epochs += 1
+        if epoch + 1 >= self.num_epochs:
+            return None
+
+        if elbo is not None and self.target_elbo is not None:
+            if elbo <= self.target_elbo:
+                self.stop_reason = (
+                    f"validation ELBO {elbo:.4f} reached the target "
+                    f"{self.target_elbo:.4f}"
+                )
+        if val_loss is not None and self.patience is not None:
+            if val_loss < self.best - self.min_delta:
+                self.best, self.bad_epochs = val_loss, 0
+            else:
+                self.bad_epochs += 1
+            if self.stop_reason is None and self.bad_epochs >= self.patience:
+                self.stop_reason = (
+                    f"no validation improvement on {self.best:.4f} "
+                    f"for {self.bad_epochs} validations"
+                )
+        if self.stop_reason is None and self.time_budget is not None:
+            epoch_seconds = self.seconds / self.epochs
+            if self.seconds + epoch_seconds > self.time_budget:
+                self.stop_reason = (
+                    f"another epoch (~{epoch_seconds:.0f} s) would exceed "
+                    f"the time budget of {self.time_budget:.0f} s"
+                )
+        return self.stop_reason
+
+    def report(self, epoch: int) -> str:
+        """Why the run stopped after epoch and the compute that saved."""
+        remaining = self.num_epochs - (epoch + 1)
+        epoch_seconds = self.seconds / max(self.epochs, 1)
+        return (
+            f"Stopped after epoch {epoch+1}/{self.num_epochs}: {self.stop_reason}. "
+            f"Saved {remaining} epochs, about {remaining * epoch_seconds / 60:.0f} min "
+            f"at {epoch_seconds:.0f} s per epoch."
+        )
+
+    def state_dict(self) -> dict:
+        return {
+            # Includes the unfinished epoch, for checkpoints taken mid-epoch
+            "seconds": self._elapsed(),
+            "epochs": self.epochs,
+            "best": self.best,
+            "bad_epochs": self.bad_epochs,
+            "stop_reason": self.stop_reason,
+        }
+
+    def load_state_dict(self, state: dict) -> None:
+        self.seconds = state["seconds"]
+        self.epochs = state["epochs"]
+        self.best = state["best"]
+        self.bad_epochs = state["bad_epochs"]
+        self.stop_reason = state["stop_reason"]
@@ -0,0 +1,182 @@
+import time
+from typing import Tuple
+
+import torch
+import torch.nn.functional as F
+
+from distributed import is_distributed
+from log_curves import validation_curve
+
+# Coreset training: each epoch trains on a selected fraction of the training
+# set instead of all of it. Every refresh epochs the model encodes the whole
+# training set once (no gradients, latent means decoded back) and the next
+# coreset is drawn from that pass:
+#
+#   "loss"       sampled without replacement with probability proportional to
+#                the reconstruction error, so hard images are seen more often
+#                while easy ones still turn up
+#   "diversity"  k-means on the latent means, then the same number of images
+#                from every cluster, so rare kinds of faces are not crowded out
+#   "random"     uniform, the baseline to compare the other two against
+#
+# In vae_train_*.py: coreset_fraction = 0.1, coreset_strategy = "loss".
+# Selections are seeded by epoch and stored in checkpoints, so a resumed run
+# trains on the same subset. Running this file compares a coreset run's
+# TensorBoard log against a full-data run: epoch time (throughput gain) and
+# validation loss (the gap).
+
+STRATEGIES = ("loss", "diversity", "random")
+
+full_log_dir = "./logs/full/"
+coreset_log_dir = "./logs/coreset/"
+
+
+def score_block(num_samples: int, rank: int, world_size: int) -> range:
+    """Rows scored by rank: contiguous, and together every row of the training set.
+
+    Blocks differ in size by at most one row, so no rank waits long on another.
+    """
+    return range(
+        rank * num_samples // world_size, (rank + 1) * num_samples // world_size
+    )
+
+
+def score(model, loader, resize, num_samples: int, offset: int = 0):
+    """Per-sample reconstruction error and latent mean over an unshuffled loader.
+
+    Rows offset.. of the (num_samples,) and (num_samples, latent_dim) results
+    are filled in loader order; under torchrun each rank scores its
+    score_block() and the blocks are summed across ranks.
+    """
+    device = next(model.parameters()).device
+    losses = torch.zeros(num_samples, device=device)
+    means = torch.zeros(num_samples, model.latent_dim, device=device)
+    row = offset
+    model.eval()
+    with torch.no_grad():
+        for images, _ in loader:
+            images = resize(images.to(device))
+            mu, _ = model.encode(images)
+            recons = model.decode(mu)
+            errors = F.mse_loss(recons, images, reduction="none").flatten(1).mean(1)
+            losses[row : row + len(images)] = errors
+            means[row : row + len(images)] = mu
+            row += len(images)
+    if is_distributed():
+        torch.distributed.all_reduce(losses)
+        torch.distributed.all_reduce(means)
+    return losses.cpu(), means.cpu()
+
+
+def kmeans(
+    points: torch.Tensor,
+    num_clusters: int,
+    generator: torch.Generator,
+    iterations: int = 10,
+    chunk: int = 16384,
+) -> torch.Tensor:
+    """Cluster label of every point after a few Lloyd iterations."""
+    centers = points[torch.randperm(len(points), generator=generator)[:num_clusters]]
+    labels = torch.empty(len(points), dtype=torch.long)
+    for _ in range(iterations):
+        for i in range(0, len(points), chunk):
+            distances = torch.cdist(points[i : i + chunk], centers)
+            labels[i : i + chunk] = distances.argmin(1)
+        sums = torch.zeros_like(centers).index_add_(0, labels, points)
+        counts = torch.bincount(labels, minlength=len(centers))
+        # Empty clusters keep their previous center
+        filled = counts > 0
+        centers[filled] = sums[filled] / counts[filled, None]
+    return labels
+
+
+def balanced_sample(
+    labels: torch.Tensor, size: int, generator: torch.Generator
+) -> torch.Tensor:
+    """size indices taken round-robin over the clusters, at random within each."""
+    order = torch.randperm(len(labels), generator=generator)
+    order = order[torch.sort(labels[order], stable=True).indices]
+    grouped = labels[order]
+    starts = torch.searchsorted(grouped, grouped, side="left")
+    # Position of every index within its cluster: 0 for the first draw, ...
+    rank = torch.arange(len(order)) - starts
+    return order[torch.sort(rank, stable=True).indices[:size]]
+
+
+def select(
+    strategy: str,
+    size: int,
+    losses: torch.Tensor,
+    means: torch.Tensor,
+    seed: int,
+    num_clusters: int = 256,
+) -> torch.Tensor:
+    """Sorted training-set indices of the next coreset."""
+    generator = torch.Generator().manual_seed(seed)
+    if strategy == "loss":
+        chosen = torch.multinomial(
+            losses.clamp_min(1e-12), size, replacement=False, generator=generator
+        )
+    elif strategy == "diversity":
+        labels = kmeans(means, min(num_clusters, size), generator)
+        chosen = balanced_sample(labels, size, generator)
+    elif strategy == "random":
+        chosen = torch.randperm(len(losses), generator=generator)[:size]
+    else:
+        raise ValueError(f"Unknown coreset strategy {strategy!r}, use {STRATEGIES}")
+    return chosen.sort().values
+
+
+def refresh(
+    model,
+    loader,
+    resize,
+    num_samples: int,
+    strategy: str,
+    fraction: float,
+    seed: int,
+    offset: int = 0,
+) -> Tuple[torch.Tensor, float]:
+    """Score the training set and draw a coreset; returns it and the seconds spent."""
+    start = time.perf_counter()
+    losses, means = score(model, loader, resize, num_samples, offset)
+    size = max(1, int(fraction * num_samples))
+    return select(strategy, size, losses, means, seed), time.perf_counter() - start
+
+
+def epoch_seconds(log_dir: str) -> float:
+    """Mean wall-clock time between consecutive Loss/Train points, NaN if < 2."""
+    curve = validation_curve(log_dir, "Loss/Train")
+    seconds = [b[0] - a[0] for a, b in zip(curve, curve[1:])]
+    if not seconds:
+        return float("nan")
+    return sum(seconds) / len(seconds)
+
+
+def compare_runs(full_log_dir: str, coreset_log_dir: str) -> dict:
+    report = {}
+    for name, log_dir in (("full", full_log_dir), ("coreset", coreset_log_dir)):
+        curve = validation_curve(log_dir)
+        report[f"{name}_epoch_seconds"] = epoch_seconds(log_dir)
+        report[f"{name}_best_val_loss"] = min(loss for _, _, loss in curve)
+        report[f"{name}_seconds"] = curve[-1][0]
+    report["speedup"] = report["full_epoch_seconds"] / report["coreset_epoch_seconds"]
+    report["val_loss_gap"] = (
+        report["coreset_best_val_loss"] - report["full_best_val_loss"]
+    )
+    return report
+
+
+if __name__ == "__main__":
+    report = compare_runs(full_log_dir, coreset_log_dir)
+    print(
+        f"Epoch time: full {report['full_epoch_seconds']:.0f} s, "
+        f"coreset {report['coreset_epoch_seconds']:.0f} s "
+        f"({report['speedup']:.1f}x faster)"
+    )
+    print(
+        f"Best validation loss: full {report['full_best_val_loss']:.4f}, "
+        f"coreset {report['coreset_best_val_loss']:.4f} "
+        f"(gap {report['val_loss_gap']:+.4f}, "
+        f"{report['val_loss_gap'] / report['full_best_val_loss']:+.1%})"
+    )
@@ -0,0 +1,112 @@
+import functools
+import time
+from typing import Callable, Tuple
+
+import numpy as np
+from PIL import Image
+from torchvision import datasets, transforms
+
+# Decode backends for CelebA JPEGs:
+#   "pil"    full-resolution decode (what ImageFolder does by default)
+#   "draft"  libjpeg DCT-domain downscale by 1/2, 1/4 or 1/8 while decoding,
+#            picking the largest reduction that still leaves at least the
+#            target size, so the final Resize only does a small step.
+# With 178x218 CelebA images this decodes at 1/2 scale for 64px training.
+# At 128px no reduction keeps both sides >= 128, so "draft" falls back to a
+# full decode there.
+
+DECODE_BACKENDS = ("pil", "draft")
+
+
+def open_image(fp, backend: str = "pil", size: Tuple[int, int] = None) -> Image.Image:
+    img = Image.open(fp)
+    if backend == "draft":
+        # Only JPEGs honour draft(); other formats decode at full size
+        img.draft("RGB", size)
+    elif backend != "pil":
+        raise ValueError(f"Unknown decode backend: {backend}")
+    return img.convert("RGB")
+
+
+def _load(path: str, backend: str, size: Tuple[int, int]) -> Image.Image:
+    with open(path, "rb") as f:
+        return open_image(f, backend, size)
+
+
+def get_loader(backend: str, img_size: int) -> Callable[[str], Image.Image]:
+    """Image loader for datasets.ImageFolder(loader=...)."""
+    if backend not in DECODE_BACKENDS:
+        raise ValueError(f"Unknown decode backend: {backend}")
+    # functools.partial of a module-level function pickles into DataLoader workers
+    return functools.partial(_load, backend=backend, size=(img_size, img_size))
+
+
+def psnr(a: np.ndarray, b: np.ndarray) -> float:
+    mse = np.mean((a.astype(np.float64) - b.astype(np.float64)) ** 2)
+    if mse == 0:
+        return float("inf")
+    return 10 * np.log10(255.0**2 / mse)
+
+
+def compare_backends(
+    data_dir: str,
+    img_size: int,
+    backend: str = "draft",
+    num_images: int = 500,
+    min_psnr: float = 30.0,
+) -> dict:
+    """Decode the same images with "pil" and backend and compare the resized output.
+
+    Raises ValueError if the mean PSNR against the full decode is below min_psnr.
+    """
+    resize = transforms.Resize((img_size, img_size))
+    samples = datasets.ImageFolder(root=data_dir).samples
+    step = max(len(samples) // num_images, 1)
+    paths = [path for path, _ in samples[::step][:num_images]]
+
+    reference_loader = get_loader("pil", img_size)
+    loader = get_loader(backend, img_size)
+    scores = []
+    max_abs_error = 0
+    reference_time = backend_time = 0.0
+    for path in paths:
+        start = time.perf_counter()
+        reference = np.asarray(resize(reference_loader(path)))
+        reference_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        candidate = np.asarray(resize(loader(path)))
+        backend_time += time.perf_counter() - start
+
+        scores.append(psnr(reference, candidate))
+        diff = np.abs(reference.astype(np.int16) - candidate.astype(np.int16))
+        max_abs_error = max(max_abs_error, int(diff.max()))
+
+    report = {
+        "backend": backend,
+        "img_size": img_size,
+        "num_images": len(paths),
+        "mean_psnr": float(np.mean(scores)),
+        "min_psnr": float(np.min(scores)),
+        "max_abs_error": max_abs_error,
+        "speedup": reference_time / backend_time,
+    }
+    if report["mean_psnr"] < min_psnr:
+        raise ValueError(
+            f"{backend} decode drifts from the full decode: "
+            f"mean PSNR {report['mean_psnr']:.2f} dB < {min_psnr} dB"
+        )
+    return report
+
+
+if __name__ == "__main__":
+    data_dir = "../../data/celeba/img_align_celeba"
+
+    for img_size in (64, 128):
+        report = compare_backends(data_dir, img_size)
+        print(
+            f"{img_size}px: mean PSNR {report['mean_psnr']:.2f} dB, "
+            f"min PSNR {report['min_psnr']:.2f} dB, "
+            f"max abs error {report['max_abs_error']}, "
+            f"decode+resize speedup x{report['speedup']:.2f}"
+        )
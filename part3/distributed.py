@@ -0,0 +1,49 @@
+import os
+from typing import List, Tuple
+
+import torch
+import torch.distributed as dist
+
+# Data-parallel training on CPU uses one process per group of cores and the gloo
+# backend. Launch the training scripts with torchrun, which sets RANK,
+# WORLD_SIZE, LOCAL_WORLD_SIZE, MASTER_ADDR and MASTER_PORT:
+#
+#   torchrun --standalone --nproc_per_node=4 vae_train_64.py
+#
+# and across machines (same command on every node, node_rank 0..nnodes-1):
+#
+#   torchrun --nnodes=2 --node_rank=0 --nproc_per_node=4 \
+#       --master_addr=node0 --master_port=29500 vae_train_64.py
+#
+# Without these variables the scripts run as a single process, as before.
+
+
+def init_distributed(backend: str = "gloo") -> Tuple[int, int]:
+    """Join the process group if launched by torchrun; returns (rank, world_size)."""
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    if world_size == 1:
+        return 0, 1
+
+    dist.init_process_group(backend)
+    # torchrun pins OMP_NUM_THREADS=1; share the node's cores between local ranks
+    local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", 1))
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // local_world_size))
+    return dist.get_rank(), world_size
+
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+
+def all_reduce_sum(values: List[float]) -> List[float]:
+    """Sum a few Python numbers across ranks (no-op on a single process)."""
+    if not is_distributed():
+        return list(values)
+    tensor = torch.tensor(values, dtype=torch.float64)
+    dist.all_reduce(tensor)
+    return tensor.tolist()
+
+
+def cleanup_distributed() -> None:
+    if is_distributed():
+        dist.destroy_process_group()
@@ -0,0 +1,212 @@
+import os
+import re
+import time
+
+import torch
+from torch.utils.data import Subset
+from torch.utils.tensorboard import SummaryWriter
+from torchvision import datasets, transforms
+
+from batch_transforms import BatchTransform
+from celeba_cache import CelebACache, split_indices
+from decoders import get_loader
+from loaders import BackgroundPrefetcher, ResumableSampler, make_loader
+from metrics import MetricAccumulator
+from shards import ShardStream
+from vae_model import build_vae, configs
+
+# Sidecar evaluator: validation out of the training loop.
+#
+# Watches weights_dir for the checkpoint_epoch_{n}.pth files the training
+# script writes with eval_checkpoints = True, one per epoch. Each is loaded
+# (memory-mapped) into a model built once per resolution, the full validation
+# split runs through it on this process's own cores, and the file is removed.
+# Epochs are evaluated in order, however far behind training the evaluator
+# is. The results go to the training run's log_dir under Eval/, next to its
+# Loss/ curves:
+#
+#   Eval/ELBO            negative ELBO per image, reconstruction + full KLD
+#   Eval/Loss            the training objective (KLD weighted by kld_weight)
+#   Eval/Reconstruction  MSE
+#   Eval/KLD
+#   Eval/PSNR            dB, per image then averaged
+#
+# Start it next to a training run with eval_checkpoints = True and
+# val_interval = 0 (or a large one) in vae_train_*.py, and give each side its
+# own cores, e.g. on a 16-core host
+#
+#   taskset -c 0-11 python vae_train_64.py
+#   python evaluator.py                     (eval_cores = range(12, 16))
+#
+# It exits after epoch num_epochs, or after the epoch where the training
+# run's controller stopped it early. The data settings must match the
+# training script's.
+
+config_name = "celeba64"  # vae_model.configs entry of the trained model
+latent_dim = None  # if the training script overrides it
+data_source = "folder"  # "folder", "cache" or "shards", as in the training script
+decode_backend = "pil"
+data_dir = "../../data/celeba/img_align_celeba"
+cache_dir = "../../data/celeba/cache"
+shards_dir = "../../data/celeba/shards"
+weights_dir = "./weights/"
+log_dir = "./logs/"
+batch_size = 256
+kld_weight = 0.00025
+val_workers = 2
+eval_cores = None  # CPU ids for this process, e.g. range(12, 16); None for all
+num_threads = None  # None for one per eval core
+poll_interval = 30  # seconds between looks at weights_dir
+num_epochs = 100  # as in the training script, exit after evaluating this epoch
+
+
+def val_dataset(img_size: int, state: dict):
+    transform = transforms.Compose(
+        [transforms.Resize((img_size, img_size)), transforms.ToTensor()]
+    )
+    if data_source == "cache":
+        return CelebACache(cache_dir, img_size, split="val"), CelebACache.collate
+    if data_source == "shards":
+        dataset = ShardStream(
+            shards_dir,
+            "val",
+            transform=transform,
+            decode_backend=decode_backend,
+            img_size=img_size,
+        )
+        return dataset, None
+    dataset = datasets.ImageFolder(
+        root=data_dir, transform=transform, loader=get_loader(decode_backend, img_size)
+    )
+    # The checkpoint records the split the run trained with
+    indices = state.get("val_indices") or split_indices(len(dataset))[1]
+    return Subset(dataset, indices), None
+
+
+def pending_epochs() -> list:
+    """Epochs with a checkpoint_epoch_{n}.pth in weights_dir, oldest first."""
+    epochs = []
+    # Training may not have created weights_dir yet
+    for name in os.listdir(weights_dir) if os.path.isdir(weights_dir) else []:
+        match = re.fullmatch(r"checkpoint_epoch_(\d+)\.pth", name)
+        if match:
+            epochs.append(int(match.group(1)))
+    return sorted(epochs)
+
+
+def load_weights(path: str) -> dict:
+    """Model weights and position of a checkpoint, without its optimizer."""
+    # mmap: only the tensors that are used get read
+    state = torch.load(path, map_location="cpu", mmap=True)
+    return {
+        key: state.get(key)
+        for key in (
+            "model",
+            "epoch",
+            "step",
+            "controller",
+            "train_img_size",
+            "val_indices",
+        )
+    }
+
+
+class Evaluator:
+
+    def __init__(self) -> None:
+        self.config = dict(configs[config_name])
+        if latent_dim is not None:
+            self.config["latent_dim"] = latent_dim
+        self.img_size = self.config["img_size"]
+        self.models = {}  # one per training resolution
+        self.loader = None
+        self.writer = SummaryWriter(log_dir)
+
+    def _model(self, train_img_size: int):
+        if train_img_size not in self.models:
+            model = build_vae(self.config, train_img_size).eval()
+            self.models[train_img_size] = model
+        return self.models[train_img_size]
+
+    def _loader(self, state: dict):
+        # Built on the first checkpoint, the workers then stay up between them
+        if self.loader is None:
+            dataset, collate_fn = val_dataset(self.img_size, state)
+            sampler = (
+                None
+                if data_source == "shards"
+                else ResumableSampler(len(dataset), shuffle=False)
+            )
+            self.loader = BackgroundPrefetcher(
+                make_loader(
+                    dataset,
+                    batch_size=batch_size,
+                    sampler=sampler,
+                    num_workers=val_workers,
+                    collate_fn=collate_fn,
+                )
+            )
+        return self.loader
+
+    def evaluate(self, state: dict) -> dict:
+        train_img_size = state["train_img_size"] or self.img_size
+        model = self._model(train_img_size)
+        model.load_state_dict(state["model"])
+        resize = BatchTransform(train_img_size)
+        metrics = MetricAccumulator(torch.device("cpu"))
+        with torch.no_grad():
+            for images, _ in self._loader(state):
+                images = resize(images)
+                outputs = model(images)
+                loss_dict = model.loss_function(*outputs, M_N=kld_weight)
+                # loss_function reports the KL divergence negated
+                elbo = loss_dict["Reconstruction_Loss"] - loss_dict["KLD"]
+                mse = (outputs[0] - images).pow(2).flatten(1).mean(1)
+                psnr = (10 * torch.log10(1 / mse.clamp_min(1e-10))).mean()
+                metrics.update(
+                    dict(loss_dict, ELBO=elbo, PSNR=psnr), batch_size=len(images)
+                )
+        return metrics.compute()
+
+    def log(self, averages: dict, epoch: int) -> None:
+        # Same x-axis as the training script: epoch index of the finished epoch
+        self.writer.add_scalar("Eval/ELBO", averages["ELBO"], epoch)
+        self.writer.add_scalar("Eval/Loss", averages["loss"], epoch)
+        self.writer.add_scalar(
+            "Eval/Reconstruction", averages["Reconstruction_Loss"], epoch
+        )
+        self.writer.add_scalar("Eval/KLD", averages["KLD"], epoch)
+        self.writer.add_scalar("Eval/PSNR", averages["PSNR"], epoch)
+        self.writer.flush()
+
+    def watch(self) -> None:
+        while True:
+            epochs = pending_epochs()
+            if not epochs:
+                time.sleep(poll_interval)
+                continue
+            path = os.path.join(weights_dir, f"checkpoint_epoch_{epochs[0]}.pth")
+            state = load_weights(path)
+            start = time.perf_counter()
+            averages = self.evaluate(state)
+            self.log(averages, state["epoch"] - 1)
+            print(
+                f"Epoch {state['epoch']}: ELBO {averages['ELBO']:.4f}, "
+                f"loss {averages['loss']:.4f}, PSNR {averages['PSNR']:.2f} dB "
+                f"({time.perf_counter() - start:.0f} s)"
+            )
+            os.remove(path)
+            stop_reason = (state["controller"] or {}).get("stop_reason")
+            if stop_reason is not None:
+                print(f"Training stopped early: {stop_reason}")
+                break
+            if state["epoch"] >= num_epochs:
+                break
+        self.writer.close()
+
+
+if __name__ == "__main__":
+    if eval_cores is not None:
+        os.sched_setaffinity(0, eval_cores)
+    torch.set_num_threads(num_threads or len(os.sched_getaffinity(0)))
+    Evaluator().watch()
@@ -0,0 +1,192 @@
+import queue
+import threading
+from typing import Callable, Optional
+
+import torch
+from torch.utils.data import (
+    DataLoader,
+    Dataset,
+    IterableDataset,
+    Sampler,
+    default_collate,
+)
+
+
+def make_loader(
+    dataset: Dataset,
+    batch_size: int,
+    shuffle: bool = False,
+    num_workers: int = 0,
+    collate_fn: Optional[Callable] = None,
+    prefetch_factor: int = 2,
+    seed: int = 42,
+    **kwargs,
+) -> DataLoader:
+    """DataLoader whose workers survive between epochs."""
+    if num_workers > 0:
+        kwargs.update(persistent_workers=True, prefetch_factor=prefetch_factor)
+    # A private generator keeps the loader from drawing on the global RNG, which
+    # would make a resumed run diverge from the original one
+    kwargs.setdefault("generator", torch.Generator().manual_seed(seed))
+    return DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=shuffle,
+        num_workers=num_workers,
+        collate_fn=collate_fn,
+        **kwargs,
+    )
+
+
+class ResumableSampler(Sampler):
+    """Shuffles with a permutation derived from (seed, epoch) and can start mid-epoch.
+
+    set_epoch(epoch, start) skips the first start samples of that epoch's global
+    order, so a resumed run sees exactly the samples it had not trained on yet.
+    With num_replicas > 1 the remaining samples are split evenly between ranks:
+    strided when shuffling, in contiguous blocks otherwise (so unshuffled
+    validation on the cached dataset keeps its zero-copy slices).
+    set_subset(indices) restricts the following epochs to those dataset
+    indices (e.g. a coreset, see coreset.py); None goes back to all of them.
+    """
+
+    def __init__(
+        self,
+        num_samples: int,
+        shuffle: bool = True,
+        seed: int = 42,
+        num_replicas: int = 1,
+        rank: int = 0,
+    ) -> None:
+        self.num_samples = num_samples
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self.start = 0
+        self.subset = None
+
+    def set_epoch(self, epoch: int, start: int = 0) -> None:
+        self.epoch = epoch
+        self.start = start
+
+    def set_subset(self, indices: Optional[torch.Tensor]) -> None:
+        self.subset = indices
+
+    def _size(self) -> int:
+        return self.num_samples if self.subset is None else len(self.subset)
+
+    def __len__(self) -> int:
+        return max(self._size() - self.start, 0) // self.num_replicas
+
+    def __iter__(self):
+        if self.shuffle:
+            generator = torch.Generator().manual_seed(self.seed + self.epoch)
+            order = torch.randperm(self._size(), generator=generator)
+        else:
+            order = torch.arange(self._size())
+        if self.subset is not None:
+            order = self.subset[order]
+        order = order[self.start :]
+
+        per_replica = len(order) // self.num_replicas
+        if self.shuffle:
+            order = order[self.rank :: self.num_replicas][:per_replica]
+        else:
+            order = order[self.rank * per_replica : (self.rank + 1) * per_replica]
+        return iter(order.tolist())
+
+
+class BackgroundPrefetcher:
+    """Iterates a loader on a background thread, keeping up to depth batches ready.
+
+    batch_transform (e.g. batch_transforms.BatchTransform) runs on the same
+    thread, so batch-level resizing overlaps with the training step.
+    """
+
+    _end = object()
+
+    def __init__(
+        self, loader, depth: int = 2, batch_transform: Optional[Callable] = None
+    ) -> None:
+        self.loader = loader
+        self.depth = depth
+        self.batch_transform = batch_transform
+
+    def __len__(self) -> int:
+        return len(self.loader)
+
+    def _produce(self, batches: queue.Queue, stop: threading.Event) -> None:
+        try:
+            for images, labels in self.loader:
+                if self.batch_transform is not None:
+                    images = self.batch_transform(images)
+                if not self._put(batches, stop, (images, labels)):
+                    return
+        except Exception as error:
+            self._put(batches, stop, error)
+            return
+        self._put(batches, stop, self._end)
+
+    @staticmethod
+    def _put(batches: queue.Queue, stop: threading.Event, item) -> bool:
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __iter__(self):
+        batches = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(
+            target=self._produce, args=(batches, stop), daemon=True
+        )
+        thread.start()
+        try:
+            while True:
+                item = batches.get()
+                if item is self._end:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # Also reached when the consumer breaks out early
+            stop.set()
+            thread.join()
+
+
+def select_preview_batch(
+    dataset: Dataset,
+    num_images: int = 8,
+    seed: int = 0,
+    collate_fn: Optional[Callable] = None,
+    batch_transform: Optional[Callable] = None,
+) -> torch.Tensor:
+    """Pick num_images fixed images once, for the per-epoch reconstruction grid."""
+    if isinstance(dataset, IterableDataset):
+        # Unshuffled streams are deterministic: take the first images
+        samples = []
+        for sample in dataset:
+            samples.append(sample)
+            if len(samples) == num_images:
+                break
+        batch = default_collate(samples)
+    else:
+        generator = torch.Generator().manual_seed(seed)
+        indices = torch.randperm(len(dataset), generator=generator)[:num_images]
+        indices = sorted(indices.tolist())
+        if hasattr(dataset, "__getitems__"):
+            batch = dataset.__getitems__(indices)
+        else:
+            batch = [dataset[i] for i in indices]
+        batch = (collate_fn or default_collate)(batch)
+
+    images = batch[0]
+    if batch_transform is not None:
+        images = batch_transform(images)
+    return images
@@ -0,0 +1,16 @@
+# Curves read back from a run's TensorBoard log, for the reports that compare
+# runs (warm_start.py, coreset.py). TensorBoard's event reader is only loaded
+# when a log is read, so the training scripts can import those modules
+# without it.
+
+
+def validation_curve(log_dir: str, tag: str = "Loss/Validation"):
+    """(seconds since the run started, epoch, loss) for every logged value."""
+    from tensorboard.backend.event_processing.event_accumulator import (
+        EventAccumulator,
+    )
+
+    events = EventAccumulator(log_dir)
+    events.Reload()
+    start = events.FirstEventTimestamp()
+    return [(e.wall_time - start, e.step, e.value) for e in events.Scalars(tag)]
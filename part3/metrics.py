@@ -0,0 +1,143 @@
+from typing import Dict, List
+
+import torch
+import torch.distributed as dist
+
+from distributed import is_distributed
+
+
+class MetricAccumulator:
+    """Running sums of loss_function outputs, kept on the device.
+
+    update() only queues tensor additions, so the training loop never waits on
+    the device for a Python float. compute() moves the sums to the host once
+    and, in distributed runs, sums them across ranks in the same all_reduce.
+    Each batch is weighted by its size, so a short last batch does not skew
+    the averages.
+    """
+
+    def __init__(self, device: torch.device) -> None:
+        self.device = device
+        self.reset()
+
+    def reset(self) -> None:
+        self.names: List[str] = []
+        # Per-metric weighted sums followed by the number of samples
+        self.totals = torch.zeros(1, dtype=torch.float64, device=self.device)
+
+    def update(self, loss_dict: Dict[str, torch.Tensor], batch_size: int) -> None:
+        if not self.names:
+            self.names = list(loss_dict)
+            self.totals = torch.zeros(
+                len(self.names) + 1, dtype=torch.float64, device=self.device
+            )
+        values = torch.stack([loss_dict[name].detach() for name in self.names])
+        self.totals[:-1] += values.to(torch.float64) * batch_size
+        self.totals[-1] += batch_size
+
+    def compute(self) -> Dict[str, float]:
+        """Averages over every sample seen since reset(), on all ranks."""
+        totals = self.totals.clone()
+        if is_distributed():
+            # A rank that saw no batches has no names yet, take them from the others
+            names = [None] * dist.get_world_size()
+            dist.all_gather_object(names, self.names)
+            if not self.names:
+                self.names = max(names, key=len)
+                totals = totals.new_zeros(len(self.names) + 1)
+            dist.all_reduce(totals)
+        *sums, count = totals.tolist()
+        return {name: value / max(count, 1) for name, value in zip(self.names, sums)}
+
+    def state_dict(self) -> dict:
+        return {"names": list(self.names), "totals": self.totals.tolist()}
+
+    def load_state_dict(self, state: dict) -> None:
+        self.names = list(state["names"])
+        self.totals = torch.tensor(
+            state["totals"], dtype=torch.float64, device=self.device
+        )
+
+
+class WorstSamples:
+    """The k samples with the highest score since reset(), with their images.
+
+    A bounded top-k: each update() merges the batch into the current k with
+    torch.topk on the device, so memory stays at k images and reconstructions
+    however long the split is, and nothing waits on the host until result().
+    Scores are per-sample losses, e.g. loss_function(..., reduction="none").
+    """
+
+    def __init__(self, k: int, device: torch.device) -> None:
+        self.k = k
+        self.device = device
+        self.reset()
+
+    def reset(self) -> None:
+        self.scores = self.indices = None
+        self.images = self.reconstructions = None
+
+    def update(
+        self,
+        scores: torch.Tensor,
+        indices: torch.Tensor,
+        images: torch.Tensor,
+        reconstructions: torch.Tensor,
+    ) -> None:
+        batch = [
+            scores.detach().float(),
+            indices.to(self.device),
+            images.detach(),
+            reconstructions.detach(),
+        ]
+        if self.scores is not None:
+            current = [self.scores, self.indices, self.images, self.reconstructions]
+            batch = [torch.cat(pair) for pair in zip(current, batch)]
+        top = batch[0].topk(min(self.k, len(batch[0]))).indices
+        self.scores, self.indices, self.images, self.reconstructions = (
+            tensor[top] for tensor in batch
+        )
+
+    def result(self):
+        """(scores, indices, images, reconstructions), worst first, over all ranks.
+
+        Empty tensors if no rank saw a batch.
+        """
+        tensors = [self.scores, self.indices, self.images, self.reconstructions]
+        if is_distributed():
+            tensors = self._gather(tensors)
+        if tensors[0] is None:
+            empty = torch.empty(0, device=self.device)
+            return empty, empty.long(), empty, empty
+        top = tensors[0].topk(min(self.k, len(tensors[0]))).indices
+        top = top[tensors[0][top] > -float("inf")]
+        return tuple(t[top] for t in tensors)
+
+    def _gather(self, tensors):
+        # A rank without batches learns the sample shapes from the others
+        layouts = [None] * dist.get_world_size()
+        layout = None
+        if self.scores is not None:
+            layout = [(t.shape[1:], t.dtype) for t in tensors]
+        dist.all_gather_object(layouts, layout)
+        known = [layout for layout in layouts if layout is not None]
+        if not known:
+            return [None] * len(tensors)
+        if self.scores is None:
+            tensors = [
+                torch.empty((0, *shape), dtype=dtype, device=self.device)
+                for shape, dtype in known[0]
+            ]
+
+        # all_gather needs equal shapes: pad every rank to k with -inf scores
+        count = len(tensors[0])
+        padded = [
+            torch.cat([t, t.new_zeros((self.k - count, *t.shape[1:]))]) for t in tensors
+        ]
+        padded[0][count:] = -float("inf")
+        gathered = []
+        for t in padded:
+            parts = [torch.empty_like(t) for _ in range(dist.get_world_size())]
+            dist.all_gather(parts, t)
+            gathered.append(torch.cat(parts))
+        return gathered
@@ -0,0 +1,54 @@
+import signal
+
+import torch
+import torch.distributed as dist
+
+from distributed import is_distributed
+
+# Preemption-safe training: SIGTERM (what schedulers and torchrun send before
+# killing a job) or SIGUSR1 (to stop a run by hand) only set a flag. The
+# training loop checks it after every step, writes a full checkpoint and
+# exits cleanly; starting the same command again resumes from it:
+#
+#   kill -USR1 <pid>                      single process
+#   kill -TERM <torchrun pid>             forwarded to every rank
+#
+# Under torchrun the ranks agree on the flag with a one-element all_reduce per
+# step, so a signal that reached a single rank still stops all of them after
+# the same step. Checkpoints record the position in the epoch as a count of
+# samples in the global shuffle order, so the run can resume on a different
+# number of ranks without repeating or skipping samples.
+
+STOP_SIGNALS = (signal.SIGTERM, signal.SIGUSR1)
+
+
+class PreemptionHandler:
+    """Turns STOP_SIGNALS into a flag polled between training steps."""
+
+    def __init__(self, signals=STOP_SIGNALS) -> None:
+        self.received = None
+        for signum in signals:
+            signal.signal(signum, self._handle)
+
+    def _handle(self, signum, frame) -> None:
+        self.received = signal.Signals(signum).name
+
+    def should_stop(self) -> bool:
+        """True on every rank once any rank has received a signal."""
+        stop = self.received is not None
+        if is_distributed():
+            flag = torch.tensor([float(stop)])
+            dist.all_reduce(flag, op=dist.ReduceOp.MAX)
+            stop = bool(flag.item())
+        return stop
+
+
+def ignore_sigusr1(worker_id: int) -> None:
+    """DataLoader worker_init_fn: a SIGUSR1 sent to the whole process group
+    (e.g. by a batch scheduler) must not kill the workers mid-epoch.
+
+    SIGTERM keeps its default action, multiprocessing uses it to stop workers
+    at exit; send it to the training process (torchrun does) rather than to
+    the whole group.
+    """
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
@@ -0,0 +1,113 @@
+import time
+from contextlib import contextmanager
+
+import torch
+from torch.profiler import (
+    ProfilerActivity,
+    profile,
+    record_function,
+    schedule,
+    tensorboard_trace_handler,
+)
+
+# Step-phase instrumentation for the training loops:
+#
+#   timer.reset()
+#   for batch in loader:
+#       timer.start_step()                  # time since the last step: data wait
+#       with timer.phase("forward"): ...
+#       with timer.phase("backward"): ...
+#       with timer.phase("optimizer"): ...
+#       timer.end_step(batch_size)          # rest of the step: "other"
+#   timer.write_scalars(writer, epoch)
+#
+# Phases are also labelled with record_function, so they show up by name in
+# torch.profiler traces.
+
+
+class PhaseTimer:
+    """Accumulates wall time per training-step phase.
+
+    CUDA kernels run asynchronously, so with synchronize=True each phase waits
+    for the device before it is timed. On CPU the timings are exact without it.
+    """
+
+    def __init__(self, synchronize: bool = False) -> None:
+        self.synchronize = synchronize
+        self.reset()
+
+    def reset(self) -> None:
+        self.totals = {}
+        self.steps = 0
+        self.images = 0
+        self.elapsed = 0.0
+        self.last = time.perf_counter()
+        self.step_start = self.last
+        self.step_phases = 0.0
+
+    def _now(self) -> float:
+        if self.synchronize:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def _add(self, name: str, seconds: float) -> None:
+        self.totals[name] = self.totals.get(name, 0.0) + seconds
+
+    def start_step(self) -> None:
+        self.step_start = self._now()
+        self.step_phases = 0.0
+        self._add("data", self.step_start - self.last)
+
+    @contextmanager
+    def phase(self, name: str):
+        with record_function(name):
+            start = self._now()
+            yield
+            seconds = self._now() - start
+        self._add(name, seconds)
+        self.step_phases += seconds
+
+    def end_step(self, batch_size: int) -> None:
+        now = self._now()
+        # Whatever the phases did not cover, e.g. loss.item() and checkpointing
+        self._add("other", now - self.step_start - self.step_phases)
+        self.elapsed += now - self.last
+        self.last = now
+        self.steps += 1
+        self.images += batch_size
+
+    def summary(self) -> dict:
+        """Mean milliseconds per step for each phase, data-wait ratio and img/s."""
+        if self.steps == 0:
+            return {}
+        result = {f"{k}_ms": 1000 * v / self.steps for k, v in self.totals.items()}
+        result["data_wait_ratio"] = self.totals["data"] / self.elapsed
+        result["images_per_sec"] = self.images / self.elapsed
+        return result
+
+    def write_scalars(self, writer, global_step: int) -> None:
+        for name, value in self.summary().items():
+            if name == "images_per_sec":
+                writer.add_scalar("Throughput/images_per_sec", value, global_step)
+            else:
+                writer.add_scalar(f"Time/{name}", value, global_step)
+
+
+def make_profiler(
+    trace_dir: str, wait: int = 5, warmup: int = 2, active: int = 5
+) -> profile:
+    """One torch.profiler capture window; call .step() after every training step.
+
+    Skips wait steps, warms up for warmup steps, records active steps and writes
+    the trace to trace_dir for TensorBoard's profiler plugin.
+    """
+    activities = [ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(ProfilerActivity.CUDA)
+    return profile(
+        activities=activities,
+        schedule=schedule(wait=wait, warmup=warmup, active=active, repeat=1),
+        on_trace_ready=tensorboard_trace_handler(trace_dir),
+        record_shapes=True,
+        profile_memory=True,
+    )
@@ -0,0 +1,96 @@
+from typing import Dict, List, Optional, Tuple
+
+from torch import nn
+from torch.optim import Optimizer
+
+# Progressive-resolution training: the model starts at a low resolution and
+# gains encoder/decoder stages as the resolution grows, e.g. for celeba64
+#
+#   progressive_schedule = {0: 32, 20: 64}
+#
+# trains epochs 0-19 at 32px with hidden_dims [64, 128, 256, 512] and epochs
+# 20+ at 64px with [32, 64, 128, 256, 512]. Batches keep coming from the
+# full-resolution pipeline and are downsampled on the fly (BatchTransform).
+# At each growth step grow() builds the larger model with vae_model.build_vae
+# and copies every block whose shapes still match: the inner encoder stages,
+# fc_mu/fc_var, decoder_input and the existing decoder stages. The new outer
+# encoder stage, the new decoder stage and final_layer start from scratch.
+# The Adam moments of the copied parameters move along with them
+# (transfer_optimizer_state); without that the first steps after a growth
+# kick the carried-over weights as hard as a fresh initialization.
+
+
+def resolution_at(schedule: Optional[Dict[int, int]], epoch: int, img_size: int) -> int:
+    """Training resolution for epoch: the entry of the latest schedule epoch <= epoch."""
+    if not schedule:
+        return img_size
+    started = [e for e in schedule if e <= epoch]
+    if not started:
+        raise ValueError(f"progressive schedule does not cover epoch {epoch}")
+    return schedule[max(started)]
+
+
+def _block(key: str) -> str:
+    parts = key.split(".")
+    if parts[0] in ("encoder", "decoder"):
+        return ".".join(parts[:2])
+    return parts[0]
+
+
+def transfer_weights(
+    src: nn.Module,
+    dst: nn.Module,
+    encoder_offset: Optional[int] = None,
+    decoder_offset: int = 0,
+) -> List[Tuple[str, str]]:
+    """Copy src's blocks into the matching blocks of a larger (or equal) dst.
+
+    Encoder stage i of src goes to stage i + encoder_offset of dst, decoder
+    stage i to i + decoder_offset. The default aligns the encoders at the
+    bottleneck and the decoders at the decoder input, as a progressive growth
+    step needs. A block is copied only if all its tensors match in shape.
+    Returns the (src key, dst key) pairs that were copied.
+    """
+    if encoder_offset is None:
+        encoder_offset = len(dst.encoder) - len(src.encoder)
+    offsets = {"encoder": encoder_offset, "decoder": decoder_offset}
+    src_blocks = {}
+    for key, value in src.state_dict().items():
+        parts = key.split(".")
+        if parts[0] in offsets:
+            parts[1] = str(int(parts[1]) + offsets[parts[0]])
+        target = ".".join(parts)
+        src_blocks.setdefault(_block(target), {})[target] = (key, value)
+
+    state = dst.state_dict()
+    copied = []
+    for block, tensors in src_blocks.items():
+        dst_keys = [key for key in state if _block(key) == block]
+        if sorted(dst_keys) != sorted(tensors) or any(
+            state[key].shape != value.shape for key, (_, value) in tensors.items()
+        ):
+            continue
+        for target, (key, value) in tensors.items():
+            state[target] = value
+            copied.append((key, target))
+    dst.load_state_dict(state)
+    return copied
+
+
+def transfer_optimizer_state(
+    src: nn.Module,
+    src_optimizer: Optimizer,
+    dst: nn.Module,
+    dst_optimizer: Optimizer,
+    copied: List[Tuple[str, str]],
+) -> None:
+    """Move per-parameter optimizer state (e.g. Adam moments) along with the
+    weights copied by transfer_weights, so the carried-over stages keep their
+    step sizes instead of restarting from a cold optimizer."""
+    src_params = dict(src.named_parameters())
+    dst_params = dict(dst.named_parameters())
+    for key, target in copied:
+        if key in src_params and src_params[key] in src_optimizer.state:
+            dst_optimizer.state[dst_params[target]] = src_optimizer.state[
+                src_params[key]
+            ]
@@ -0,0 +1,229 @@
+import json
+import os
+import time
+
+import torch
+from torch import nn
+from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+from celeba_cache import CelebACache
+from vae_model import VanillaVAE, configs
+from warm_start import load_weights
+
+# Post-training int8 quantization of the VanillaVAE decoder for CPU sampling
+# and interpolation (decode() of a batch of latents).
+#
+# The decoder of the model's inference_copy() (BatchNorm already folded) is
+# quantized in one of two ways:
+#
+#   "static"   decoder_input, every ConvTranspose2d/Conv2d and LeakyReLU run in
+#              int8, except in float_layers; activation ranges are calibrated
+#              on latents of cached training images (posterior samples around
+#              the encoder's means) mixed with N(0, 1) draws, which is what
+#              sample() decodes. final_layer stays in float by default: the
+#              last convolution's outputs span tens of units ahead of the Tanh
+#              and all the detail is in its steep part, which int8 flattens
+#              (about 29 dB instead of 49 dB on a CelebA model).
+#   "dynamic"  int8 weights for decoder_input only, activations quantized on
+#              the fly; the convolutions stay fp32 (PyTorch has no dynamic
+#              quantization for them). No calibration needed.
+#
+# The report compares both against the fp32 decoder on held-out latents of
+# the validation split and on prior samples (PSNR in dB over the output
+# activation's range: 2 for Tanh, 1 for Sigmoid), and times decode() at each
+# of batch_sizes. The static decoder is saved as TorchScript:
+#
+#   decoder = torch.jit.load("./weights/vae_decoder_int8.pt")
+#   images = decoder(torch.randn(128, latent_dim))
+#
+# part4/vae_interpolation_celeba.ipynb decodes its interpolations with it when
+# it exists: run this with config_name = "celeba128", latent_dim = 128 and
+# weights_path = "../part4/weights/vae_celeba_128.pth".
+
+config_name = "celeba64"
+latent_dim = None  # if the training script overrides it
+weights_path = "./weights/checkpoint_last.pth"  # state_dict or full checkpoint
+cache_dir = "../../data/celeba/cache"  # None to use prior samples only
+backend = "x86"  # torch.backends.quantized.engine, "qnnpack" on ARM
+calibration_samples = 2048
+eval_samples = 1024
+float_layers = ["final_layer"]  # VanillaVAE submodules kept in fp32 by "static"
+batch_sizes = [1, 16, 128]
+warmup_steps = 2
+timed_steps = 10
+quantized_path = "./weights/vae_decoder_int8.pt"
+results_path = "./results/quantization_report.json"
+
+
+class Decoder(nn.Module):
+    """decode() of a VanillaVAE as a module of its own, for quantization."""
+
+    def __init__(self, model: VanillaVAE) -> None:
+        super().__init__()
+        self.model = model
+
+    def forward(self, z: torch.Tensor) -> torch.Tensor:
+        return self.model.decode(z)
+
+
+def quantize_decoder(
+    model: VanillaVAE,
+    calibration_latents: torch.Tensor = None,
+    mode: str = "static",
+    float_layers: list = (),
+    batch_size: int = 256,
+) -> nn.Module:
+    """int8 decoder of model, a module mapping latents to images.
+
+    float_layers names submodules of model left in fp32 by static quantization.
+    """
+    torch.backends.quantized.engine = backend
+    decoder = Decoder(model.inference_copy()).eval()
+    if mode == "dynamic":
+        return quantize_dynamic(decoder, {nn.Linear}, dtype=torch.qint8)
+    if mode != "static":
+        raise ValueError(f"Unknown quantization mode {mode!r}, use static or dynamic")
+    if calibration_latents is None:
+        raise ValueError("Static quantization needs calibration_latents")
+
+    qconfig_mapping = get_default_qconfig_mapping(backend)
+    for name in float_layers:
+        qconfig_mapping.set_module_name(f"model.{name}", None)
+    prepared = prepare_fx(
+        decoder,
+        qconfig_mapping,
+        example_inputs=(calibration_latents[:1],),
+    )
+    with torch.no_grad():
+        for z in calibration_latents.split(batch_size):
+            prepared(z)
+    return convert_fx(prepared)
+
+
+def cached_latents(
+    model: VanillaVAE, split: str, num_samples: int, batch_size: int = 256
+) -> torch.Tensor:
+    """Posterior samples z ~ q(z|x) of the first num_samples cached images of split."""
+    dataset = CelebACache(cache_dir, model.img_size, split=split)
+    num_samples = min(num_samples, len(dataset))
+    latents = []
+    with torch.no_grad():
+        for start in range(0, num_samples, batch_size):
+            rows = list(range(start, min(start + batch_size, num_samples)))
+            images, _ = CelebACache.collate(dataset.__getitems__(rows))
+            mu, log_var = model.encode(images)
+            latents.append(model.reparameterize(mu, log_var))
+    return torch.cat(latents)
+
+
+def latents(model: VanillaVAE, split: str, num_samples: int) -> torch.Tensor:
+    """Half posterior samples of cached images (if any), the rest prior draws."""
+    prior = torch.randn(num_samples, model.latent_dim)
+    if cache_dir is None:
+        return prior
+    posterior = cached_latents(model, split, num_samples // 2)
+    return torch.cat([posterior, prior[len(posterior) :]])
+
+
+def output_range(model: VanillaVAE) -> float:
+    """Width of decode()'s outputs: [-1, 1] after Tanh, [0, 1] after Sigmoid."""
+    return 2.0 if isinstance(model.final_layer[-1], nn.Tanh) else 1.0
+
+
+def psnr(reference: torch.Tensor, test: torch.Tensor, data_range: float = 1.0) -> float:
+    """Mean PSNR in dB of test against reference, per image, peak data_range."""
+    mse = (reference - test).pow(2).flatten(1).mean(1)
+    return (10 * torch.log10(data_range**2 / mse.clamp_min(1e-10))).mean().item()
+
+
+def decode_all(decoder: nn.Module, z: torch.Tensor, batch_size: int = 256):
+    with torch.no_grad():
+        return torch.cat([decoder(chunk) for chunk in z.split(batch_size)])
+
+
+def latency(decoder: nn.Module, batch_size: int, latent_dim: int) -> float:
+    """Mean seconds of one decode of batch_size latents."""
+    z = torch.randn(batch_size, latent_dim)
+    with torch.no_grad():
+        for _ in range(warmup_steps):
+            decoder(z)
+        start = time.perf_counter()
+        for _ in range(timed_steps):
+            decoder(z)
+    return (time.perf_counter() - start) / timed_steps
+
+
+def compare(model: VanillaVAE, decoders: dict, eval_latents: torch.Tensor) -> dict:
+    """PSNR of every decoder against fp32 and its decode latency per batch size."""
+    reference = decode_all(decoders["fp32"], eval_latents)
+    # cached_latents fills the first half, see latents()
+    posterior = len(eval_latents) // 2 if cache_dir is not None else 0
+    data_range = output_range(model)
+    report = {}
+    for name, decoder in decoders.items():
+        images = decode_all(decoder, eval_latents)
+        row = {"psnr_db": psnr(reference, images, data_range)}
+        if posterior:
+            row["psnr_posterior_db"] = psnr(
+                reference[:posterior], images[:posterior], data_range
+            )
+        row["psnr_prior_db"] = psnr(
+            reference[posterior:], images[posterior:], data_range
+        )
+        row["latency_ms"], row["images_per_second"] = {}, {}
+        for batch_size in batch_sizes:
+            seconds = latency(decoder, batch_size, model.latent_dim)
+            row["latency_ms"][batch_size] = 1000 * seconds
+            row["images_per_second"][batch_size] = batch_size / seconds
+        report[name] = row
+    return report
+
+
+if __name__ == "__main__":
+    torch.manual_seed(42)
+    config = dict(configs[config_name])
+    if latent_dim is not None:
+        config["latent_dim"] = latent_dim
+    model = VanillaVAE(**config)
+    model.load_state_dict(load_weights(weights_path))
+    model.eval()
+
+    calibration = latents(model, "train", calibration_samples)
+    held_out = latents(model, "val", eval_samples)
+    decoders = {
+        "fp32": Decoder(model.inference_copy()).eval(),
+        "dynamic": quantize_decoder(model, mode="dynamic"),
+        "static": quantize_decoder(model, calibration, "static", float_layers),
+    }
+    report = compare(model, decoders, held_out)
+
+    print(f"{config_name}, {len(held_out)} held-out latents, backend {backend}")
+    for name, row in report.items():
+        timings = ", ".join(
+            f"{batch_size}: {row['latency_ms'][batch_size]:.1f} ms "
+            f"({row['images_per_second'][batch_size]:.0f} img/s)"
+            for batch_size in batch_sizes
+        )
+        quality = "" if name == "fp32" else f"PSNR {row['psnr_db']:.1f} dB, "
+        print(f"  {name:8s} {quality}{timings}")
+
+    os.makedirs(os.path.dirname(quantized_path), exist_ok=True)
+    example = torch.randn(batch_sizes[-1], model.latent_dim)
+    with torch.no_grad():
+        torch.jit.save(torch.jit.trace(decoders["static"], example), quantized_path)
+    os.makedirs(os.path.dirname(results_path), exist_ok=True)
+    with open(results_path, "w") as f:
+        json.dump(
+            {
+                "config": config_name,
+                "weights": weights_path,
+                "backend": backend,
+                "float_layers": float_layers,
+                "calibration_samples": len(calibration),
+                "eval_samples": len(held_out),
+                "decoders": report,
+            },
+            f,
+            indent=2,
+        )
@@ -0,0 +1,357 @@
+import io
+import itertools
+import json
+import os
+import random
+import struct
+from typing import List, Optional
+
+import numpy as np
+import torch.distributed as dist
+from PIL import Image
+from torch.utils.data import DataLoader, IterableDataset, Subset, get_worker_info
+from torchvision import datasets, transforms
+from tqdm import tqdm
+
+from celeba_cache import split_indices
+from decoders import get_loader, open_image
+
+# A shard directory holds manifest.json and {split}-{i:05d}.bin files.
+# Each .bin file is a plain sequence of records:
+#   <uint32 label><uint32 payload length><payload>
+# where the payload is either the original JPEG bytes ("jpeg" encoding) or a
+# uint8 (C, H, W) array ("raw" encoding, used for pre-resized images and IDX data).
+
+RECORD_HEADER = struct.Struct("<II")
+MANIFEST = "manifest.json"
+
+
+class ShardWriter:
+
+    def __init__(self, out_dir: str, split: str, samples_per_shard: int) -> None:
+        self.out_dir = out_dir
+        self.split = split
+        self.samples_per_shard = samples_per_shard
+        self.shards = []
+        self.file = None
+        self.count = 0
+
+    def _next_shard(self) -> None:
+        self._close_shard()
+        name = f"{self.split}-{len(self.shards):05d}.bin"
+        self.file = open(os.path.join(self.out_dir, name), "wb")
+        self.shards.append({"file": name, "count": 0})
+
+    def _close_shard(self) -> None:
+        if self.file is not None:
+            self.shards[-1]["bytes"] = self.file.tell()
+            self.file.close()
+            self.file = None
+
+    def write(self, payload: bytes, label: int) -> None:
+        if self.file is None or self.shards[-1]["count"] == self.samples_per_shard:
+            self._next_shard()
+        self.file.write(RECORD_HEADER.pack(label, len(payload)))
+        self.file.write(payload)
+        self.shards[-1]["count"] += 1
+        self.count += 1
+
+    def close(self) -> dict:
+        self._close_shard()
+        return {"count": self.count, "shards": self.shards}
+
+
+def write_manifest(out_dir: str, encoding: str, shape, splits: dict) -> str:
+    manifest = {"version": 1, "encoding": encoding, "shape": shape, "splits": splits}
+    path = os.path.join(out_dir, MANIFEST)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + ".tmp", path)
+    return path
+
+
+def pack_image_folder(
+    data_dir: str,
+    out_dir: str,
+    encoding: str = "jpeg",
+    img_size: Optional[int] = None,
+    samples_per_shard: int = 4096,
+    val_fraction: float = 0.1,
+    seed: int = 42,
+    num_workers: int = 8,
+    decode_backend: str = "pil",
+) -> str:
+    """Pack an ImageFolder (CelebA) into train/val shards.
+
+    "jpeg" copies the original file bytes, "raw" stores images decoded with
+    decode_backend and resized to img_size.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    if encoding == "raw":
+        transform = transforms.Compose(
+            [transforms.Resize((img_size, img_size)), transforms.PILToTensor()]
+        )
+        dataset = datasets.ImageFolder(
+            root=data_dir,
+            transform=transform,
+            loader=get_loader(decode_backend, img_size),
+        )
+        shape = [3, img_size, img_size]
+    elif encoding == "jpeg":
+        dataset = datasets.ImageFolder(root=data_dir)
+        shape = None
+    else:
+        raise ValueError(f"Unknown encoding: {encoding}")
+
+    train_indices, val_indices = split_indices(len(dataset), val_fraction, seed)
+    splits = {}
+    for split, indices in (("train", train_indices), ("val", val_indices)):
+        writer = ShardWriter(out_dir, split, samples_per_shard)
+        if encoding == "raw":
+            loader = DataLoader(
+                Subset(dataset, indices), batch_size=256, num_workers=num_workers
+            )
+            for images, labels in tqdm(loader, desc=f"Packing {split}"):
+                for image, label in zip(images.numpy(), labels.tolist()):
+                    writer.write(image.tobytes(), label)
+        else:
+            for i in tqdm(indices, desc=f"Packing {split}"):
+                path, label = dataset.samples[i]
+                with open(path, "rb") as f:
+                    writer.write(f.read(), label)
+        splits[split] = writer.close()
+
+    return write_manifest(out_dir, encoding, shape, splits)
+
+
+def load_idx(filename: str) -> np.ndarray:
+    with open(filename, "rb") as f:
+        zero, data_type, dims = struct.unpack(">HBB", f.read(4))
+        shape = tuple(struct.unpack(">I", f.read(4))[0] for _ in range(dims))
+        return np.frombuffer(f.read(), dtype=np.uint8).reshape(shape)
+
+
+def pack_idx(
+    out_dir: str,
+    train_images: str,
+    train_labels: str,
+    test_images: Optional[str] = None,
+    test_labels: Optional[str] = None,
+    samples_per_shard: int = 16384,
+    val_fraction: float = 0.1,
+    seed: int = 42,
+) -> str:
+    """Pack MNIST / Fashion-MNIST IDX files into train/val(/test) shards."""
+    os.makedirs(out_dir, exist_ok=True)
+    images = load_idx(train_images)
+    labels = load_idx(train_labels)
+    train_indices, val_indices = split_indices(len(images), val_fraction, seed)
+    parts = [
+        ("train", images, labels, train_indices),
+        ("val", images, labels, val_indices),
+    ]
+    if test_images is not None:
+        test = load_idx(test_images)
+        parts.append(("test", test, load_idx(test_labels), range(len(test))))
+
+    splits = {}
+    for split, split_images, split_labels, indices in parts:
+        writer = ShardWriter(out_dir, split, samples_per_shard)
+        for i in indices:
+            writer.write(split_images[i].tobytes(), int(split_labels[i]))
+        splits[split] = writer.close()
+
+    shape = [1, *images.shape[1:]]
+    return write_manifest(out_dir, "raw", shape, splits)
+
+
+def read_shard(path: str):
+    with open(path, "rb", buffering=1 << 20) as f:
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if not header:
+                return
+            label, length = RECORD_HEADER.unpack(header)
+            yield f.read(length), label
+
+
+class ShardStream(IterableDataset):
+    """Streams samples from packed shards.
+
+    Shards are shuffled per epoch, split across ranks and DataLoader workers,
+    and samples are shuffled again through a buffer of buffer_size. Every rank
+    and worker derives the same shard order from (seed, epoch), so the split is
+    deterministic. With fewer shards than readers, records are dealt out one
+    by one instead. JPEG payloads are decoded with decode_backend (see
+    decoders.py), which needs img_size for the "draft" backend.
+
+    Call set_epoch before each epoch; with persistent workers each worker copy
+    also advances its own epoch after every pass. set_epoch(epoch, skip_batches,
+    batch_size) before the first pass resumes an epoch part way through.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        split: str = "train",
+        transform=None,
+        shuffle: bool = False,
+        buffer_size: int = 2048,
+        seed: int = 42,
+        decode_backend: str = "pil",
+        img_size: Optional[int] = None,
+    ) -> None:
+        super().__init__()
+        self.root = root
+        self.split = split
+        self.transform = transform
+        self.shuffle = shuffle
+        self.buffer_size = buffer_size
+        self.seed = seed
+        self.decode_backend = decode_backend
+        self.decode_size = (img_size, img_size) if img_size is not None else None
+        self.epoch = 0
+        self.skip_batches = 0
+        self.batch_size = None
+
+        with open(os.path.join(root, MANIFEST)) as f:
+            manifest = json.load(f)
+        self.encoding = manifest["encoding"]
+        self.shape = manifest["shape"]
+        self.shards = manifest["splits"][split]["shards"]
+        self.count = manifest["splits"][split]["count"]
+
+    def set_epoch(
+        self, epoch: int, skip_batches: int = 0, batch_size: Optional[int] = None
+    ) -> None:
+        self.epoch = epoch
+        self.skip_batches = skip_batches
+        self.batch_size = batch_size
+
+    def __len__(self) -> int:
+        rank, world_size = _rank_and_world_size()
+        return self.count // world_size
+
+    def _decode(self, payload: bytes) -> Image.Image:
+        if self.encoding == "jpeg":
+            return open_image(
+                io.BytesIO(payload), self.decode_backend, self.decode_size
+            )
+        array = np.frombuffer(payload, dtype=np.uint8).reshape(self.shape)
+        if array.shape[0] == 1:
+            return Image.fromarray(array[0], mode="L")
+        return Image.fromarray(array.transpose(1, 2, 0), mode="RGB")
+
+    def _readers(self, epoch: int):
+        # Shard order for this epoch, dealt round-robin to every (rank, worker)
+        rank, world_size = _rank_and_world_size()
+        worker_info = get_worker_info()
+        num_workers = worker_info.num_workers if worker_info is not None else 1
+        worker_id = worker_info.id if worker_info is not None else 0
+
+        order = list(range(len(self.shards)))
+        if self.shuffle:
+            random.Random(self.seed + epoch).shuffle(order)
+
+        total = world_size * num_workers
+        reader = rank * num_workers + worker_id
+        if len(order) >= total:
+            shards = [self.shards[i] for i in order[reader::total]]
+            counts = [
+                sum(self.shards[i]["count"] for i in order[r::total])
+                for r in range(total)
+            ]
+            start, stride = 0, 1
+        else:
+            # Fewer shards than readers (e.g. a small val split): every reader
+            # walks all of them and keeps every total-th record
+            shards = [self.shards[i] for i in order]
+            counts = [len(range(r, self.count, total)) for r in range(total)]
+            start, stride = reader, total
+        if world_size > 1 and self.shuffle:
+            # Training ranks must see the same number of samples or the
+            # gradient all_reduce hangs: every reader stops at the smallest
+            # reader's share. Validation has no per-step collectives and
+            # keeps every sample.
+            counts = [min(counts)] * total
+
+        first = rank * num_workers
+        return shards, (start, stride), counts[first : first + num_workers], worker_id
+
+    def _skipped_samples(self, worker_counts: List[int], worker_id: int) -> int:
+        # The DataLoader yields one batch per worker in turn, skipping workers
+        # that ran out, so the first skip_batches batches can be replayed here
+        if self.skip_batches == 0:
+            return 0
+        batches = [-(-count // self.batch_size) for count in worker_counts]
+        taken = [0] * len(batches)
+        remaining = self.skip_batches
+        while remaining > 0 and taken != batches:
+            for w in range(len(batches)):
+                if remaining > 0 and taken[w] < batches[w]:
+                    taken[w] += 1
+                    remaining -= 1
+        return min(taken[worker_id] * self.batch_size, worker_counts[worker_id])
+
+    def _records(self, shards: List[dict]):
+        for shard in shards:
+            yield from read_shard(os.path.join(self.root, shard["file"]))
+
+    def __iter__(self):
+        epoch = self.epoch
+        self.epoch += 1
+        shards, (start, stride), worker_counts, worker_id = self._readers(epoch)
+        skip = self._skipped_samples(worker_counts, worker_id)
+        self.skip_batches = 0
+
+        records = itertools.islice(self._records(shards), start, None, stride)
+        records = itertools.islice(records, worker_counts[worker_id])
+        if self.shuffle:
+            rank, _ = _rank_and_world_size()
+            rng = random.Random(f"{self.seed}-{epoch}-{rank}-{worker_id}")
+            records = _buffer_shuffle(records, self.buffer_size, rng)
+        # Skipped records are replayed undecoded, so the shuffle stays identical
+        records = itertools.islice(records, skip, None)
+
+        for payload, label in records:
+            image = self._decode(payload)
+            if self.transform is not None:
+                image = self.transform(image)
+            yield image, label
+
+
+def _buffer_shuffle(records, buffer_size: int, rng: random.Random):
+    buffer = []
+    for record in records:
+        if len(buffer) < buffer_size:
+            buffer.append(record)
+            continue
+        i = rng.randrange(buffer_size)
+        yield buffer[i]
+        buffer[i] = record
+    rng.shuffle(buffer)
+    yield from buffer
+
+
+def _rank_and_world_size():
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank(), dist.get_world_size()
+    return 0, 1
+
+
+if __name__ == "__main__":
+    pack_image_folder("../../data/celeba/img_align_celeba", "../../data/celeba/shards")
+    pack_idx(
+        "./data/MNIST/shards",
+        "./data/MNIST/raw/train-images-idx3-ubyte",
+        "./data/MNIST/raw/train-labels-idx1-ubyte",
+        "./data/MNIST/raw/t10k-images-idx3-ubyte",
+        "./data/MNIST/raw/t10k-labels-idx1-ubyte",
+    )
+    pack_idx(
+        "./data/fMNIST/shards",
+        "./data/fMNIST/train-images-idx3-ubyte",
+        "./data/fMNIST/train-labels-idx1-ubyte",
+        "./data/fMNIST/t10k-images-idx3-ubyte",
+        "./data/fMNIST/t10k-labels-idx1-ubyte",
+    )
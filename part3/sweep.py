@@ -0,0 +1,230 @@
+import csv
+import itertools
+import math
+import os
+import random
+import time
+
+import torch
+import torch.multiprocessing as mp
+from torch.optim import Adam, lr_scheduler
+from torch.utils.tensorboard import SummaryWriter
+
+from celeba_cache import CelebACache
+from checkpoint import load_checkpoint, training_state
+from metrics import MetricAccumulator
+from vae_model import build_vae, configs
+
+# Hyperparameter sweep with successive halving.
+#
+# Trials are points of search_space, trained in a pool of processes with
+# threads_per_trial intra-op threads each (parallel_trials defaults to
+# filling the cores). The decoded cache written by celeba_cache.py is copied
+# once into a shared-memory tensor that every pool process maps read-only, so
+# there are no loader workers and no per-trial copies of the dataset.
+#
+# Successive halving: every trial trains min_epochs and is validated, the
+# best 1/eta (at least one) continue to eta times as many epochs (resuming
+# from their last state), and so on up to max_epochs. Each trial logs to its
+# own TensorBoard run in sweep_dir (same tags as vae_train_64.py), and
+# results.csv next to those runs has one row per trial, best first. Trial
+# states are kept in their run directories, so starting an interrupted sweep
+# again picks up where it stopped.
+#
+#   python sweep.py
+#   tensorboard --logdir ./logs/sweep/
+
+config_name = "celeba64"
+cache_dir = "../../data/celeba/cache"  # written by celeba_cache.py
+search_space = {
+    "learning_rate": [0.001, 0.005, 0.01],
+    "kld_weight": [0.0001, 0.00025, 0.001],
+    "latent_dim": [64, 128, 256],
+    "scheduler_gamma": [0.9, 0.95],
+}
+num_trials = 27  # sampled from the grid, None for all of it
+min_epochs = 1  # epochs every trial gets
+eta = 3  # keep the best 1/eta at each rung, which then trains eta times longer
+max_epochs = 9
+batch_size = 256
+val_samples = None  # cap on validation images per evaluation, None for all
+# Validation uses one KL weight for every trial, so that trials with different
+# kld_weight are ranked on the same objective
+val_kld_weight = 0.00025
+threads_per_trial = 1
+parallel_trials = None  # None for os.cpu_count() // threads_per_trial
+sweep_dir = "./logs/sweep/"
+seed = 42
+
+# Set in each pool process by _init_worker
+_images = None
+_train_size = None
+
+
+def sample_trials() -> list:
+    grid = [
+        dict(zip(search_space, values))
+        for values in itertools.product(*search_space.values())
+    ]
+    if num_trials is not None and num_trials < len(grid):
+        grid = random.Random(seed).sample(grid, num_trials)
+    return [dict(hparams, trial=f"trial_{i:03d}") for i, hparams in enumerate(grid)]
+
+
+def rung_epochs() -> list:
+    """Epoch budgets of the successive-halving rungs, e.g. [1, 3, 9]."""
+    epochs = [min_epochs]
+    while epochs[-1] < max_epochs:
+        epochs.append(min(epochs[-1] * eta, max_epochs))
+    return epochs
+
+
+def shared_dataset():
+    """All cached images in one shared-memory uint8 tensor, train rows first."""
+    dataset = CelebACache(cache_dir, configs[config_name]["img_size"], split="all")
+    images = torch.empty(dataset.images.shape, dtype=torch.uint8).share_memory_()
+    images.copy_(torch.from_numpy(dataset.images))
+    return images, dataset.index["train_size"]
+
+
+def _init_worker(images: torch.Tensor, train_size: int, num_threads: int) -> None:
+    global _images, _train_size
+    torch.set_num_interop_threads(1)
+    torch.set_num_threads(num_threads)
+    _images, _train_size = images, train_size
+
+
+def _batches(rows: torch.Tensor):
+    for i in range(0, len(rows), batch_size):
+        # Sorted rows keep the gather sequential in memory
+        yield _images[rows[i : i + batch_size].sort().values].float().div_(255)
+
+
+def _validate(model) -> float:
+    metrics = MetricAccumulator(torch.device("cpu"))
+    stop = len(_images) if val_samples is None else _train_size + val_samples
+    model.eval()
+    with torch.no_grad():
+        for images in _batches(torch.arange(_train_size, min(stop, len(_images)))):
+            metrics.update(
+                model.loss_function(*model(images), M_N=val_kld_weight),
+                batch_size=len(images),
+            )
+    return metrics.compute()
+
+
+def run_trial(trial: dict, epochs: int) -> dict:
+    """Train trial up to epochs (resuming its saved state) and validate it."""
+    trial_dir = os.path.join(sweep_dir, trial["trial"])
+    state_path = os.path.join(trial_dir, "state.pth")
+    torch.manual_seed(seed)
+    model = build_vae(dict(configs[config_name], latent_dim=trial["latent_dim"]))
+    optimizer = Adam(model.parameters(), lr=trial["learning_rate"])
+    scheduler = lr_scheduler.ExponentialLR(optimizer, gamma=trial["scheduler_gamma"])
+    state = load_checkpoint(state_path)
+    start_epoch, val_loss, seconds = 0, math.inf, 0.0
+    if state is not None:
+        # Earlier rung, or an interrupted sweep started again
+        model.load_state_dict(state["model"])
+        optimizer.load_state_dict(state["optimizer"])
+        scheduler.load_state_dict(state["scheduler"])
+        start_epoch, val_loss = state["epoch"], state["val_loss"]
+        seconds = state["seconds"]
+
+    writer = SummaryWriter(trial_dir)
+    start = time.perf_counter()
+    train_metrics = MetricAccumulator(torch.device("cpu"))
+    for epoch in range(start_epoch, epochs):
+        model.train()
+        train_metrics.reset()
+        order = torch.randperm(
+            _train_size, generator=torch.Generator().manual_seed(seed + epoch)
+        )
+        for images in _batches(order):
+            optimizer.zero_grad()
+            loss_dict = model.loss_function(*model(images), M_N=trial["kld_weight"])
+            loss_dict["loss"].backward()
+            optimizer.step()
+            train_metrics.update(loss_dict, batch_size=len(images))
+        scheduler.step()
+        train_loss = train_metrics.compute()["loss"]
+        val = _validate(model)
+        writer.add_scalar("Loss/Train", train_loss, epoch)
+        writer.add_scalar("Loss/Validation", val["loss"], epoch)
+        writer.add_scalar("Loss/Reconstruction", val["Reconstruction_Loss"], epoch)
+        writer.add_scalar("Loss/KLD", val["KLD"], epoch)
+        val_loss = val["loss"] if math.isfinite(val["loss"]) else math.inf
+        if val_loss == math.inf:
+            break  # diverged, no point training further
+    writer.close()
+    epochs = max(epochs, start_epoch)
+    seconds += time.perf_counter() - start
+    state = training_state(
+        model, optimizer, scheduler, epochs, 0, val_loss=val_loss, seconds=seconds
+    )
+    torch.save(state, state_path)
+    return dict(trial, epochs=epochs, val_loss=val_loss, seconds=seconds)
+
+
+def successive_halving(pool, trials: list) -> dict:
+    results = {}
+    survivors = trials
+    for epochs in rung_epochs():
+        rung = pool.starmap(run_trial, [(trial, epochs) for trial in survivors])
+        results.update((row["trial"], row) for row in rung)
+        rung.sort(key=lambda row: row["val_loss"])
+        print(
+            f"{epochs} epochs: {len(rung)} trials, best {rung[0]['trial']} "
+            f"val loss {rung[0]['val_loss']:.4f}"
+        )
+        # At least one trial goes on, so the best one reaches max_epochs
+        kept = {row["trial"] for row in rung[: max(1, len(rung) // eta)]}
+        survivors = [trial for trial in survivors if trial["trial"] in kept]
+        if not survivors:
+            break
+    return results
+
+
+def write_table(results: dict) -> str:
+    path = os.path.join(sweep_dir, "results.csv")
+    rows = sorted(results.values(), key=lambda row: row["val_loss"])
+    with open(path, "w", newline="") as f:
+        table = csv.DictWriter(
+            f,
+            fieldnames=["trial", *search_space, "epochs", "val_loss", "seconds"],
+        )
+        table.writeheader()
+        table.writerows(rows)
+    # Also in TensorBoard's HPARAMS tab, one entry per trial run
+    for row in rows:
+        with SummaryWriter(os.path.join(sweep_dir, row["trial"])) as writer:
+            writer.add_hparams(
+                {name: row[name] for name in search_space},
+                {"hparam/val_loss": row["val_loss"], "hparam/epochs": row["epochs"]},
+                run_name=".",
+            )
+    return path
+
+
+if __name__ == "__main__":
+    os.makedirs(sweep_dir, exist_ok=True)
+    trials = sample_trials()
+    images, train_size = shared_dataset()
+    processes = parallel_trials or max(1, (os.cpu_count() or 1) // threads_per_trial)
+    print(
+        f"{len(trials)} trials, rungs {rung_epochs()} epochs, "
+        f"{processes} x {threads_per_trial} threads, "
+        f"{images.numel() / 2**20:.0f} MiB shared"
+    )
+    context = mp.get_context("spawn")
+    with context.Pool(
+        processes,
+        initializer=_init_worker,
+        initargs=(images, train_size, threads_per_trial),
+    ) as pool:
+        results = successive_halving(pool, trials)
+    path = write_table(results)
+    best = min(results.values(), key=lambda row: row["val_loss"])
+    print(f"Best {best['trial']}: val loss {best['val_loss']:.4f}")
+    print(", ".join(f"{name} {best[name]}" for name in search_space))
+    print(f"Table: {path}")
@@ -0,0 +1,235 @@
+import itertools
+import json
+import os
+import resource
+import socket
+import time
+
+import torch
+import torch.multiprocessing as mp
+from torch.optim import Adam
+from torchvision import datasets, transforms
+
+from celeba_cache import CelebACache
+from decoders import get_loader
+from loaders import BackgroundPrefetcher, ResumableSampler, make_loader
+from shards import ShardStream
+from vae_model import build_vae, configs
+
+# Throughput tuner for the training scripts on this host.
+#
+# Runs short windows of the real training step (loader, forward, backward,
+# Adam) over a grid of DataLoader workers, intra-op threads, inter-op threads
+# and micro-batch size, each in a fresh process because inter-op threads can
+# only be set once per process. Trials whose trainer plus loader workers use
+# more than ram_budget_gb are discarded, and larger micro-batches for the
+# same settings are not tried. The fastest trial is saved as a profile:
+#
+#   python tune.py                       -> ./profiles/<hostname>.json
+#   tuning_profile = "./profiles/<hostname>.json"   in vae_train_*.py
+#
+# The batch size is tuned as micro_batch_size, so the effective batch (and
+# with it the optimization) stays batch_size. Each trial times the training
+# scripts' step: the loader yields batch_size images, gradients accumulate
+# over micro-batches and the optimizer steps once per batch. Trials run as a
+# single process; under torchrun, init_distributed still splits the cores
+# between ranks.
+
+config_name = "celeba64"
+data_source = "folder"  # as in the training scripts
+decode_backend = "pil"
+data_dir = "../../data/celeba/img_align_celeba"
+cache_dir = "../../data/celeba/cache"
+shards_dir = "../../data/celeba/shards"
+cores = os.cpu_count() or 1
+train_workers_grid = sorted({0, 2, 4, min(8, cores), min(10, cores)})
+num_threads_grid = sorted({max(1, cores // 4), max(1, cores // 2), cores})
+interop_threads_grid = [1, 2]
+batch_size = 256  # as in the training scripts
+micro_batch_sizes = [64, 128, 256]
+ram_budget_gb = None  # None for 80% of this host's memory
+warmup_steps = 3
+timed_steps = 10
+kld_weight = 0.00025
+profiles_dir = "./profiles/"
+
+
+def total_memory() -> int:
+    with open("/proc/meminfo") as f:
+        for line in f:
+            if line.startswith("MemTotal:"):
+                return int(line.split()[1]) * 1024
+    raise RuntimeError("MemTotal missing from /proc/meminfo")
+
+
+def _rss(pid) -> int:
+    with open(f"/proc/{pid}/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def _child_pids():
+    pids = []
+    for task in os.listdir("/proc/self/task"):
+        with open(f"/proc/self/task/{task}/children") as f:
+            pids.extend(int(pid) for pid in f.read().split())
+    return pids
+
+
+def trial_dataset(img_size: int):
+    transform = transforms.Compose(
+        [transforms.Resize((img_size, img_size)), transforms.ToTensor()]
+    )
+    if data_source == "cache":
+        dataset = CelebACache(cache_dir, img_size, split="train")
+        return dataset, ResumableSampler(len(dataset)), CelebACache.collate
+    if data_source == "shards":
+        dataset = ShardStream(
+            shards_dir,
+            "train",
+            transform,
+            shuffle=True,
+            decode_backend=decode_backend,
+            img_size=img_size,
+        )
+        return dataset, None, None
+    dataset = datasets.ImageFolder(
+        root=data_dir, transform=transform, loader=get_loader(decode_backend, img_size)
+    )
+    return dataset, ResumableSampler(len(dataset)), None
+
+
+def trial(params: dict) -> dict:
+    """img/s and memory of one training window with params applied."""
+    torch.set_num_interop_threads(params["interop_threads"])
+    torch.set_num_threads(params["num_threads"])
+    torch.manual_seed(42)
+    config = configs[config_name]
+    model = build_vae(config)
+    optimizer = Adam(model.parameters(), lr=0.005)
+    dataset, sampler, collate_fn = trial_dataset(config["img_size"])
+    loader = BackgroundPrefetcher(
+        make_loader(
+            dataset,
+            batch_size=batch_size,
+            sampler=sampler,
+            num_workers=params["train_workers"],
+            collate_fn=collate_fn,
+            drop_last=True,
+        )
+    )
+
+    batches = iter(loader)
+    images_seen = 0
+    for step in range(warmup_steps + timed_steps):
+        if step == warmup_steps:
+            start = time.perf_counter()
+        images, _ = next(batches)
+        optimizer.zero_grad()
+        for micro_images in images.split(params["micro_batch_size"]):
+            outputs = model(micro_images)
+            loss = model.loss_function(*outputs, M_N=kld_weight)["loss"]
+            (loss * (len(micro_images) / len(images))).backward()
+        optimizer.step()
+        if step >= warmup_steps:
+            images_seen += len(images)
+    elapsed = time.perf_counter() - start
+
+    # Workers are still alive here: count their current RSS
+    worker_rss = sum(_rss(pid) for pid in _child_pids())
+    batches.close()
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return dict(
+        params,
+        images_per_sec=images_seen / elapsed,
+        memory_bytes=peak_rss + worker_rss,
+    )
+
+
+def _spawned(params: dict, results) -> None:
+    try:
+        results.put(trial(params))
+    except Exception as error:
+        results.put(dict(params, error=repr(error)))
+
+
+def tune() -> dict:
+    budget = (ram_budget_gb or 0.8 * total_memory() / 2**30) * 2**30
+    context = mp.get_context("spawn")
+    rows = []
+    for train_workers, num_threads, interop_threads in itertools.product(
+        train_workers_grid, num_threads_grid, interop_threads_grid
+    ):
+        # Micro-batches above batch_size would all run as batch_size
+        for micro_batch_size in [m for m in micro_batch_sizes if m <= batch_size]:
+            params = dict(
+                train_workers=train_workers,
+                num_threads=num_threads,
+                interop_threads=interop_threads,
+                micro_batch_size=micro_batch_size,
+            )
+            results = context.SimpleQueue()
+            process = context.Process(target=_spawned, args=(params, results))
+            process.start()
+            process.join()
+            if process.exitcode != 0 and results.empty():
+                # Killed (e.g. by the OOM killer) or crashed outside Python
+                row = dict(params, error=f"exit code {process.exitcode}")
+            else:
+                row = results.get()
+            row["within_budget"] = row.get("memory_bytes", budget + 1) <= budget
+            rows.append(row)
+            print(
+                ", ".join(f"{k} {v}" for k, v in params.items())
+                + (
+                    f": {row['images_per_sec']:.1f} img/s, "
+                    f"{row['memory_bytes'] / 2**30:.1f} GiB"
+                    if "error" not in row
+                    else f": {row['error']}"
+                )
+            )
+            if not row["within_budget"]:
+                break  # larger micro-batches only need more memory
+
+    candidates = [row for row in rows if row["within_budget"]]
+    if not candidates:
+        raise RuntimeError(f"No trial fits in {budget / 2**30:.1f} GiB")
+    best = max(candidates, key=lambda row: row["images_per_sec"])
+    return {
+        "host": socket.gethostname(),
+        "cpu_count": cores,
+        "config": config_name,
+        "data_source": data_source,
+        "ram_budget_bytes": budget,
+        "train_workers": best["train_workers"],
+        # Validation is not timed; half the training workers keep it fed
+        "val_workers": best["train_workers"] // 2,
+        "num_threads": best["num_threads"],
+        "interop_threads": best["interop_threads"],
+        "micro_batch_size": best["micro_batch_size"],
+        "images_per_sec": best["images_per_sec"],
+        "trials": rows,
+    }
+
+
+def load_profile(path: str) -> dict:
+    """Read a profile written by tune.py and apply its thread settings."""
+    with open(path) as f:
+        profile = json.load(f)
+    torch.set_num_interop_threads(profile["interop_threads"])
+    torch.set_num_threads(profile["num_threads"])
+    return profile
+
+
+if __name__ == "__main__":
+    profile = tune()
+    os.makedirs(profiles_dir, exist_ok=True)
+    path = os.path.join(profiles_dir, f"{profile['host']}.json")
+    with open(path, "w") as f:
+        json.dump(profile, f, indent=2)
+    print(
+        f"Best: {profile['images_per_sec']:.1f} img/s with "
+        f"train_workers {profile['train_workers']}, "
+        f"num_threads {profile['num_threads']}, "
+        f"interop_threads {profile['interop_threads']}, "
+        f"micro_batch_size {profile['micro_batch_size']} -> {path}"
+    )
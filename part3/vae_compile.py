@@ -0,0 +1,155 @@
+import contextlib
+import os
+import warnings
+from typing import Callable, Optional
+
+import torch
+from torch import nn
+
+# Compiled execution for VanillaVAE:
+#   "eager"    plain PyTorch modules
+#   "script"   TorchScript traces of forward, encode and decode (one trace per
+#              train/eval mode, since tracing freezes BatchNorm's training flag).
+#              Calls under autocast (use_bf16) run eager: a trace also freezes
+#              the dtypes it saw, and its backward then mixes fp32 and bf16.
+#   "compile"  torch.compile (TorchInductor, C++ codegen on CPU). The generated
+#              code is kept in cache_dir, so the full compile cost is only paid
+#              by the first run with a given config.
+# A mode that fails on its first call falls back to the next one, compile ->
+# script -> eager, with a warning. Compiled graphs share parameters with the
+# eager model, so the optimizer and checkpoints keep using the model itself.
+
+COMPILE_MODES = ("eager", "script", "compile")
+
+
+def enable_compile_cache(cache_dir: str) -> None:
+    """Persist TorchInductor's generated code and FX graphs in cache_dir."""
+    from torch._inductor import config, utils
+
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = os.path.abspath(cache_dir)
+    # Inductor memoizes the directory the first time it is used
+    utils.cache_dir.cache_clear()
+    config.fx_graph_cache = True
+
+
+class _WithFallback:
+    """Calls compiled, and switches to fallback for good if the first call fails."""
+
+    def __init__(self, compiled: Callable, fallback: Callable, name: str) -> None:
+        self.compiled = compiled
+        self.fallback = fallback
+        self.name = name
+        self.checked = False
+
+    def __call__(self, *args):
+        if self.checked:
+            return self.compiled(*args)
+        try:
+            result = self.compiled(*args)
+        except Exception as error:
+            warnings.warn(f"{self.name} failed ({error!r}), falling back")
+            self.compiled = self.fallback
+            result = self.fallback(*args)
+        self.checked = True
+        return result
+
+
+class _Traced:
+    """TorchScript traces of a model's methods, traced lazily per train/eval mode."""
+
+    def __init__(self, model: nn.Module, method: str) -> None:
+        self.model = model
+        self.method = method
+        self.traces = {}
+        self.warned = False
+
+    def __call__(self, input: torch.Tensor):
+        if torch.is_autocast_cpu_enabled() or torch.is_autocast_enabled():
+            if not self.warned:
+                warnings.warn(f"TorchScript {self.method} runs eager under autocast")
+                self.warned = True
+            return getattr(self.model, self.method)(input)
+        training = self.model.training
+        if training not in self.traces:
+            self.traces[training] = self._trace(input)
+        return self.traces[training](input)
+
+    def _trace(self, input: torch.Tensor):
+        # Tracing runs the model once: keep BN statistics and the RNG untouched
+        buffers = [buffer.clone() for buffer in self.model.buffers()]
+        with torch.random.fork_rng(devices=[]), warnings.catch_warnings():
+            warnings.simplefilter("ignore", torch.jit.TracerWarning)
+            traced = torch.jit.trace_module(
+                self.model, {self.method: input}, check_trace=False
+            )
+        with torch.no_grad():
+            for buffer, saved in zip(self.model.buffers(), buffers):
+                buffer.copy_(saved)
+        return getattr(traced, self.method)
+
+
+class CompiledVAE:
+    """Runs forward, encode, decode and sample of a VAE through compiled graphs.
+
+    Call it like the model for training steps; loss_function, state_dict,
+    train()/eval() and everything else stay on the wrapped model. The wrapped
+    module can also be a DistributedDataParallel, in which case only forward is
+    available and "script" falls back to eager.
+    """
+
+    def __init__(
+        self, model: nn.Module, mode: str = "compile", cache_dir: Optional[str] = None
+    ) -> None:
+        if mode not in COMPILE_MODES:
+            raise ValueError(f"Unknown compile mode: {mode}")
+        self.model = model
+        self.mode = mode
+        module = getattr(model, "module", model)  # unwrap DDP
+        eager = {"forward": model, "encode": module.encode, "decode": module.decode}
+
+        if mode == "eager":
+            self._methods = eager
+            return
+
+        distributed = module is not model
+        scripted = {}
+        for name, method in eager.items():
+            if distributed:
+                scripted[name] = method
+            else:
+                scripted[name] = _WithFallback(
+                    _Traced(module, name), method, f"TorchScript {name}"
+                )
+        if mode == "script":
+            self._methods = scripted
+            return
+
+        if cache_dir is not None:
+            enable_compile_cache(cache_dir)
+        self._methods = {
+            name: _WithFallback(
+                torch.compile(method), scripted[name], f"torch.compile {name}"
+            )
+            for name, method in eager.items()
+        }
+
+    def __call__(self, input: torch.Tensor):
+        return self._methods["forward"](input)
+
+    def no_sync(self):
+        """DistributedDataParallel.no_sync() of the wrapped module, if it has one."""
+        if hasattr(self.model, "no_sync"):
+            return self.model.no_sync()
+        return contextlib.nullcontext()
+
+    def encode(self, input: torch.Tensor):
+        return self._methods["encode"](input)
+
+    def decode(self, z: torch.Tensor) -> torch.Tensor:
+        return self._methods["decode"](z)
+
+    def sample(self, num_samples: int, current_device) -> torch.Tensor:
+        module = getattr(self.model, "module", self.model)
+        z = torch.randn(num_samples, module.latent_dim).to(current_device)
+        return self.decode(z)
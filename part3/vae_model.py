@@ -0,0 +1,269 @@
+from torch import nn
+from abc import abstractmethod
+from typing import List, Any, TypeVar
+import copy
+import torch
+import torch.nn.functional as F
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+Tensor = TypeVar("torch.tensor")
+
+
+class BaseVAE(nn.Module):
+
+    def __init__(self) -> None:
+        super(BaseVAE, self).__init__()
+
+    def encode(self, input: Tensor) -> List[Tensor]:
+        raise NotImplementedError
+
+    def decode(self, input: Tensor) -> Any:
+        raise NotImplementedError
+
+    def sample(self, batch_size: int, current_device: int, **kwargs) -> Tensor:
+        raise NotImplementedError
+
+    def generate(self, x: Tensor, **kwargs) -> Tensor:
+        raise NotImplementedError
+
+    @abstractmethod
+    def forward(self, *inputs: Tensor) -> Tensor:
+        pass
+
+    @abstractmethod
+    def loss_function(self, *inputs: Any, **kwargs) -> Tensor:
+        pass
+
+
+class VanillaVAE(BaseVAE):
+
+    def __init__(
+        self,
+        in_channels: int,
+        latent_dim: int,
+        hidden_dims: List = None,
+        img_size: int = 64,
+        output_activation: str = "tanh",
+        **kwargs,
+    ) -> None:
+        super(VanillaVAE, self).__init__()
+
+        self.latent_dim = latent_dim
+        self.in_channels = in_channels
+        # channels_last in copies made by inference_copy()
+        self.memory_format = torch.contiguous_format
+
+        modules = []
+        if hidden_dims is None:
+            hidden_dims = [32, 64, 128, 256, 512]
+        # Copy, the decoder reverses the list in place
+        hidden_dims = list(hidden_dims)
+        self.hidden_dims = list(hidden_dims)
+        # Each stage halves the resolution, e.g. 64px -> 2x2 with 5 stages
+        self.final_size = img_size // 2 ** len(hidden_dims)
+        if self.final_size < 1 or img_size % 2 ** len(hidden_dims):
+            raise ValueError(
+                f"img_size {img_size} is not divisible by 2**{len(hidden_dims)}"
+            )
+        self.img_size = img_size
+        flat_dim = hidden_dims[-1] * self.final_size**2
+        out_channels = in_channels
+
+        # Build Encoder
+        for h_dim in hidden_dims:
+            modules.append(
+                nn.Sequential(
+                    nn.Conv2d(
+                        in_channels,
+                        out_channels=h_dim,
+                        kernel_size=3,
+                        stride=2,
+                        padding=1,
+                    ),
+                    nn.BatchNorm2d(h_dim),
+                    nn.LeakyReLU(),
+                )
+            )
+            in_channels = h_dim
+
+        self.encoder = nn.Sequential(*modules)
+        self.fc_mu = nn.Linear(flat_dim, latent_dim)
+        self.fc_var = nn.Linear(flat_dim, latent_dim)
+
+        # Build Decoder
+        modules = []
+
+        self.decoder_input = nn.Linear(latent_dim, flat_dim)
+
+        hidden_dims.reverse()
+
+        for i in range(len(hidden_dims) - 1):
+            modules.append(
+                nn.Sequential(
+                    nn.ConvTranspose2d(
+                        hidden_dims[i],
+                        hidden_dims[i + 1],
+                        kernel_size=3,
+                        stride=2,
+                        padding=1,
+                        output_padding=1,
+                    ),
+                    nn.BatchNorm2d(hidden_dims[i + 1]),
+                    nn.LeakyReLU(),
+                )
+            )
+
+        self.decoder = nn.Sequential(*modules)
+
+        self.final_layer = nn.Sequential(
+            nn.ConvTranspose2d(
+                hidden_dims[-1],
+                hidden_dims[-1],
+                kernel_size=3,
+                stride=2,
+                padding=1,
+                output_padding=1,
+            ),
+            nn.BatchNorm2d(hidden_dims[-1]),
+            nn.LeakyReLU(),
+            nn.Conv2d(hidden_dims[-1], out_channels, kernel_size=3, padding=1),
+            nn.Sigmoid() if output_activation == "sigmoid" else nn.Tanh(),
+        )
+
+    def encode(self, input: Tensor) -> List[Tensor]:
+        input = input.contiguous(memory_format=self.memory_format)
+        result = self.encoder(input)
+        result = torch.flatten(result, start_dim=1)
+
+        # Split the result into mu and var components
+        # of the latent Gaussian distribution
+        mu = self.fc_mu(result)
+        log_var = self.fc_var(result)
+
+        return [mu, log_var]
+
+    def decode(self, z: Tensor) -> Tensor:
+        result = self.decoder_input(z)
+        result = result.view(-1, self.hidden_dims[-1], self.final_size, self.final_size)
+        result = result.contiguous(memory_format=self.memory_format)
+        result = self.decoder(result)
+        result = self.final_layer(result)
+        return result
+
+    def reparameterize(self, mu: Tensor, logvar: Tensor) -> Tensor:
+        std = torch.exp(0.5 * logvar)
+        eps = torch.randn_like(std)
+        return eps * std + mu
+
+    def forward(self, input: Tensor, **kwargs) -> List[Tensor]:
+        mu, log_var = self.encode(input)
+        z = self.reparameterize(mu, log_var)
+        return [self.decode(z), input, mu, log_var]
+
+    def loss_function(self, *args, **kwargs) -> dict:
+        recons = args[0]
+        input = args[1]
+        mu = args[2]
+        log_var = args[3]
+
+        kld_weight = kwargs["M_N"]  # Account for the minibatch samples from the dataset
+        if kwargs.get("reduction", "mean") == "none":
+            # One value per sample, e.g. to find the worst reconstructions
+            recons_loss = F.mse_loss(recons, input, reduction="none")
+            recons_loss = recons_loss.flatten(1).mean(1)
+            kld_loss = -0.5 * torch.sum(1 + log_var - mu**2 - log_var.exp(), dim=1)
+        else:
+            recons_loss = F.mse_loss(recons, input)
+            kld_loss = torch.mean(
+                -0.5 * torch.sum(1 + log_var - mu**2 - log_var.exp(), dim=1), dim=0
+            )
+
+        loss = recons_loss + kld_weight * kld_loss
+        return {
+            "loss": loss,
+            "Reconstruction_Loss": recons_loss.detach(),
+            "KLD": -kld_loss.detach(),
+        }
+
+    def sample(self, num_samples: int, current_device: int, **kwargs) -> Tensor:
+        z = torch.randn(num_samples, self.latent_dim)
+
+        z = z.to(current_device)
+
+        samples = self.decode(z)
+        return samples
+
+    def generate(self, x: Tensor, **kwargs) -> Tensor:
+
+        return self.forward(x)[0]
+
+    def inference_copy(self) -> "VanillaVAE":
+        """Eval-only copy with BatchNorm folded into the preceding (transposed)
+        convolutions and all activations in channels-last memory format.
+
+        Gives the same encode/decode/sample outputs as the model in eval mode,
+        up to float rounding. Not meant for training: it has no BatchNorm layers.
+        """
+        model = copy.deepcopy(self).eval().requires_grad_(False)
+        for block in [*model.encoder, *model.decoder, model.final_layer]:
+            for i in range(len(block) - 1):
+                conv, bn = block[i], block[i + 1]
+                if isinstance(conv, (nn.Conv2d, nn.ConvTranspose2d)) and isinstance(
+                    bn, nn.BatchNorm2d
+                ):
+                    transpose = isinstance(conv, nn.ConvTranspose2d)
+                    block[i] = fuse_conv_bn_eval(conv, bn, transpose=transpose)
+                    block[i + 1] = nn.Identity()
+        model.memory_format = torch.channels_last
+        return model.to(memory_format=torch.channels_last)
+
+
+def build_vae(config: dict, img_size: int = None) -> VanillaVAE:
+    """VanillaVAE for config, at img_size instead of config["img_size"] if given.
+
+    A lower resolution drops the outermost (highest resolution) stages of
+    hidden_dims, so the bottleneck and all inner stages keep their shapes:
+    celeba64 at 32px is hidden_dims [64, 128, 256, 512] with the same 2x2x512
+    bottleneck, and its weights carry over when the model grows back to 64px
+    (see progressive.py).
+    """
+    config = dict(config)
+    target_size = config["img_size"]
+    img_size = img_size or target_size
+    hidden_dims = list(config.get("hidden_dims") or [32, 64, 128, 256, 512])
+    drop = 0
+    while target_size > img_size and drop < len(hidden_dims) - 1:
+        target_size //= 2
+        drop += 1
+    if target_size != img_size:
+        raise ValueError(
+            f"Can't build a {config['img_size']}px config at {img_size}px, "
+            "sizes must differ by a power of two"
+        )
+    config.update(img_size=img_size, hidden_dims=hidden_dims[drop:])
+    return VanillaVAE(**config)
+
+
+# Shipped training configurations; img_size is the input resolution
+configs = {
+    "celeba64": dict(
+        in_channels=3,
+        latent_dim=128,
+        img_size=64,
+        hidden_dims=[32, 64, 128, 256, 512],
+    ),
+    "celeba128": dict(
+        in_channels=3,
+        latent_dim=64,
+        img_size=128,
+        hidden_dims=[32, 64, 128, 256, 512, 1024],
+    ),
+    # vae_train_mnist.ipynb: 28px digits resized to 32px
+    "mnist": dict(
+        in_channels=1,
+        latent_dim=20,
+        img_size=32,
+        hidden_dims=[32, 64, 128],
+        output_activation="sigmoid",
+    ),
+}
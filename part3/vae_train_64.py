@@ -1,181 +1,49 @@
-from torch import nn
-from abc import abstractmethod
-from typing import List, Any, TypeVar
 import torch
-from torch.utils.data import DataLoader, random_split, Subset
+from torch.utils.data import random_split, Subset
 from torchvision import datasets, transforms, utils
 from torch.optim import Adam, lr_scheduler
+from torch.nn.parallel import DistributedDataParallel
 from torch.utils.tensorboard import SummaryWriter
 from tqdm import tqdm
 import os
-import torch.nn.functional as F
-
-Tensor = TypeVar("torch.tensor")
-
-
-class BaseVAE(nn.Module):
-
-    def __init__(self) -> None:
-        super(BaseVAE, self).__init__()
-
-    def encode(self, input: Tensor) -> List[Tensor]:
-        raise NotImplementedError
-
-    def decode(self, input: Tensor) -> Any:
-        raise NotImplementedError
-
-    def sample(self, batch_size: int, current_device: int, **kwargs) -> Tensor:
-        raise NotImplementedError
-
-    def generate(self, x: Tensor, **kwargs) -> Tensor:
-        raise NotImplementedError
-
-    @abstractmethod
-    def forward(self, *inputs: Tensor) -> Tensor:
-        pass
-
-    @abstractmethod
-    def loss_function(self, *inputs: Any, **kwargs) -> Tensor:
-        pass
-
-
-class VanillaVAE(BaseVAE):
-
-    def __init__(
-        self, in_channels: int, latent_dim: int, hidden_dims: List = None, **kwargs
-    ) -> None:
-        super(VanillaVAE, self).__init__()
-
-        self.latent_dim = latent_dim
-
-        modules = []
-        if hidden_dims is None:
-            hidden_dims = [32, 64, 128, 256, 512]
-
-        # Build Encoder
-        for h_dim in hidden_dims:
-            modules.append(
-                nn.Sequential(
-                    nn.Conv2d(
-                        in_channels,
-                        out_channels=h_dim,
-                        kernel_size=3,
-                        stride=2,
-                        padding=1,
-                    ),
-                    nn.BatchNorm2d(h_dim),
-                    nn.LeakyReLU(),
-                )
-            )
-            in_channels = h_dim
-
-        self.encoder = nn.Sequential(*modules)
-        self.fc_mu = nn.Linear(hidden_dims[-1] * 4, latent_dim)
-        self.fc_var = nn.Linear(hidden_dims[-1] * 4, latent_dim)
-
-        # Build Decoder
-        modules = []
-
-        self.decoder_input = nn.Linear(latent_dim, hidden_dims[-1] * 4)
-
-        hidden_dims.reverse()
-
-        for i in range(len(hidden_dims) - 1):
-            modules.append(
-                nn.Sequential(
-                    nn.ConvTranspose2d(
-                        hidden_dims[i],
-                        hidden_dims[i + 1],
-                        kernel_size=3,
-                        stride=2,
-                        padding=1,
-                        output_padding=1,
-                    ),
-                    nn.BatchNorm2d(hidden_dims[i + 1]),
-                    nn.LeakyReLU(),
-                )
-            )
-
-        self.decoder = nn.Sequential(*modules)
-
-        self.final_layer = nn.Sequential(
-            nn.ConvTranspose2d(
-                hidden_dims[-1],
-                hidden_dims[-1],
-                kernel_size=3,
-                stride=2,
-                padding=1,
-                output_padding=1,
-            ),
-            nn.BatchNorm2d(hidden_dims[-1]),
-            nn.LeakyReLU(),
-            nn.Conv2d(hidden_dims[-1], out_channels=3, kernel_size=3, padding=1),
-            nn.Tanh(),
-        )
-
-    def encode(self, input: Tensor) -> List[Tensor]:
-        result = self.encoder(input)
-        result = torch.flatten(result, start_dim=1)
-
-        # Split the result into mu and var components
-        # of the latent Gaussian distribution
-        mu = self.fc_mu(result)
-        log_var = self.fc_var(result)
-
-        return [mu, log_var]
-
-    def decode(self, z: Tensor) -> Tensor:
-        result = self.decoder_input(z)
-        result = result.view(-1, 512, 2, 2)
-        result = self.decoder(result)
-        result = self.final_layer(result)
-        return result
-
-    def reparameterize(self, mu: Tensor, logvar: Tensor) -> Tensor:
-        std = torch.exp(0.5 * logvar)
-        eps = torch.randn_like(std)
-        return eps * std + mu
-
-    def forward(self, input: Tensor, **kwargs) -> List[Tensor]:
-        mu, log_var = self.encode(input)
-        z = self.reparameterize(mu, log_var)
-        return [self.decode(z), input, mu, log_var]
-
-    def loss_function(self, *args, **kwargs) -> dict:
-        recons = args[0]
-        input = args[1]
-        mu = args[2]
-        log_var = args[3]
-
-        kld_weight = kwargs["M_N"]  # Account for the minibatch samples from the dataset
-        recons_loss = F.mse_loss(recons, input)
-
-        kld_loss = torch.mean(
-            -0.5 * torch.sum(1 + log_var - mu**2 - log_var.exp(), dim=1), dim=0
-        )
-
-        loss = recons_loss + kld_weight * kld_loss
-        return {
-            "loss": loss,
-            "Reconstruction_Loss": recons_loss.detach(),
-            "KLD": -kld_loss.detach(),
-        }
-
-    def sample(self, num_samples: int, current_device: int, **kwargs) -> Tensor:
-        z = torch.randn(num_samples, self.latent_dim)
-
-        z = z.to(current_device)
-
-        samples = self.decode(z)
-        return samples
-
-    def generate(self, x: Tensor, **kwargs) -> Tensor:
-
-        return self.forward(x)[0]
-
+import itertools
+import contextlib
+from vae_model import build_vae
+from activation_checkpoint import enable_checkpointing
+from progressive import (
+    resolution_at,
+    transfer_optimizer_state,
+    transfer_weights,
+)
+from celeba_cache import CelebACache
+from shards import ShardStream
+from decoders import get_loader
+from batch_transforms import BatchTransform, sample_transform
+from loaders import (
+    BackgroundPrefetcher,
+    ResumableSampler,
+    make_loader,
+    select_preview_batch,
+)
+from checkpoint import (
+    AsyncCheckpointer,
+    load_checkpoint,
+    restore_rng_state,
+    training_state,
+)
+from distributed import all_reduce_sum, cleanup_distributed, init_distributed
+from preemption import PreemptionHandler, ignore_sigusr1
+from metrics import MetricAccumulator, WorstSamples
+from controller import TrainingController, lr_range_test
+import coreset
+from vae_compile import CompiledVAE
+from profiling import PhaseTimer, make_profiler
+from tune import load_profile
 
 # Define paths
 data_dir = "../../data/celeba/img_align_celeba"
+cache_dir = "../../data/celeba/cache"  # written by celeba_cache.py
+shards_dir = "../../data/celeba/shards"  # written by shards.py
 weights_dir = "./weights/"
 results_dir = "./results/"
 reconstructions = results_dir + "reconstructions/"
@@ -188,107 +56,585 @@ os.makedirs(results_dir, exist_ok=True)
 os.makedirs(log_dir, exist_ok=True)
 
 # Hyperparameters
-batch_size = 256
+batch_size = 256  # images per optimizer step
+micro_batch_size = None  # e.g. 64: accumulate gradients over smaller forward passes
 learning_rate = 0.005
 weight_decay = 0.0
 scheduler_gamma = 0.95
+lr_schedule = "exponential"  # or "plateau": multiply by plateau_factor when it stalls
+plateau_factor = 0.5
+plateau_patience = 2  # validations without improvement before the LR drops
 num_epochs = 100
+# Early stopping and LR search, see controller.py
+lr_range_test_steps = None  # e.g. 100: set learning_rate by LR range test first
+target_elbo = None  # stop once the validation ELBO (reconstruction + KLD) is this low
+early_stop_patience = None  # stop after this many validations without improvement
+time_budget_hours = None  # stop before the next epoch would exceed this training time
 latent_dim = 128
 img_size = 64
 kld_weight = 0.00025  # weight of KL divergence in the loss
+data_source = "folder"  # "folder", "cache" (celeba_cache.py) or "shards" (shards.py)
+decode_backend = "pil"  # "pil" or "draft" (DCT-domain downscale, see decoders.py)
+transform_mode = "sample"  # "sample" (PIL per image) or "batch" (batch_transforms.py)
+train_workers = 10  # "batch" mode usually needs fewer
+val_workers = 4
+prefetch_batches = 4  # batches prepared by the background thread ahead of the step
+val_interval = 1  # validate every val_interval epochs (and after the last one)
+# 0 leaves validation to evaluator.py, run alongside on spare cores
+eval_checkpoints = False  # weights/checkpoint_epoch_{n}.pth per epoch for evaluator.py
+val_batches = None  # cap on batches per validation pass, None for all, 0 for none
+worst_k = 16  # worst validation reconstructions saved per validation, 0 for none
+resume = True  # continue from weights/checkpoint_last.pth if it exists
+checkpoint_interval = 200  # steps between mid-epoch checkpoints
+init_weights = None  # state_dict to start a new run from, e.g. from warm_start.py
+use_bf16 = False  # autocast conv/linear layers to bfloat16, loss stays fp32
+compile_mode = "eager"  # "eager", "script" (TorchScript) or "compile" (torch.compile)
+compile_cache_dir = "./compile_cache/"  # torch.compile artifacts, reused across runs
+profile_epoch = None  # epoch whose first steps are traced by torch.profiler
+progressive_schedule = None  # e.g. {0: 32, 20: img_size}, see progressive.py
+# Blocks recomputed during backward to save memory, e.g. ["encoder.0", "final_layer"]
+# or ["encoder", "decoder"]; see bench_checkpointing.py for the trade-off
+checkpoint_blocks = []
+# Train each epoch on a scored subset of the training set, see coreset.py
+coreset_fraction = None  # e.g. 0.1
+coreset_strategy = "loss"  # "loss", "diversity" or "random"
+coreset_refresh = 5  # epochs between re-scoring the training set
+tuning_profile = None  # e.g. "./profiles/<hostname>.json" written by tune.py
+
+if tuning_profile:
+    # Loader workers, micro-batch and thread counts measured fastest on this host
+    profile = load_profile(tuning_profile)
+    train_workers = profile["train_workers"]
+    val_workers = profile["val_workers"]
+    micro_batch_size = profile["micro_batch_size"]
 
 torch.manual_seed(42)
 
 # Device configuration
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
+# Data-parallel mode when launched with torchrun (see distributed.py)
+rank, world_size = init_distributed()
+is_main = rank == 0
+
 # Transformations
-transform = transforms.Compose(
-    [
-        transforms.Resize((img_size, img_size)),
-        transforms.ToTensor(),
-    ]
+if transform_mode == "batch":
+    # Workers only decode, the batch is resized and scaled in the main process
+    transform = sample_transform
+    batch_transform = BatchTransform(img_size)
+else:
+    transform = transforms.Compose(
+        [
+            transforms.Resize((img_size, img_size)),
+            transforms.ToTensor(),
+        ]
+    )
+    batch_transform = None
+collate_fn = None
+
+if data_source == "cache":
+    # Pre-decoded images, split persisted by celeba_cache.build_cache
+    train_dataset = CelebACache(cache_dir, img_size, split="train")
+    val_dataset = CelebACache(cache_dir, img_size, split="val")
+    if transform_mode == "batch":
+        collate_fn = CelebACache.collate_raw
+    else:
+        collate_fn = CelebACache.collate
+elif data_source == "shards":
+    # Sequential shard reads, shuffled by shard and through a sample buffer
+    shard_options = dict(
+        transform=transform, decode_backend=decode_backend, img_size=img_size
+    )
+    train_dataset = ShardStream(shards_dir, "train", shuffle=True, **shard_options)
+    val_dataset = ShardStream(shards_dir, "val", **shard_options)
+else:
+    # Load dataset
+    dataset = datasets.ImageFolder(
+        root=data_dir,
+        transform=transform,
+        loader=get_loader(decode_backend, img_size),
+    )
+
+    # Limit dataset size
+    # train_dataset = Subset(dataset, range(100000))  # Use only 100 images for training
+    # val_dataset = Subset(dataset, range(100000, 101000))  # Use 10 images for validation
+
+    # Split dataset into train and validation sets
+    train_size = int(0.9 * len(dataset))
+    val_size = len(dataset) - train_size
+    train_dataset, val_dataset = random_split(dataset, [train_size, val_size])
+
+# Resume from the last full checkpoint if there is one
+checkpoint_path = os.path.join(weights_dir, "checkpoint_last.pth")
+resume_state = load_checkpoint(checkpoint_path) if resume else None
+if resume_state is not None and data_source == "folder":
+    # Keep the split the run started with
+    train_dataset.indices = resume_state["train_indices"]
+    val_dataset.indices = resume_state["val_indices"]
+split_state = {
+    "train_indices": getattr(train_dataset, "indices", None),
+    "val_indices": getattr(val_dataset, "indices", None),
+}
+
+# Shuffle order derived from (seed, epoch), so an epoch can restart part way
+if data_source == "shards":
+    train_sampler = None  # ShardStream shuffles itself
+else:
+    train_sampler = ResumableSampler(
+        len(train_dataset), num_replicas=world_size, rank=rank
+    )
+
+if coreset_fraction:
+    if data_source == "shards":
+        raise ValueError('coreset_fraction needs data_source "folder" or "cache"')
+    # Unshuffled pass over the training set, in contiguous blocks per rank
+    score_rows = coreset.score_block(len(train_dataset), rank, world_size)
+    score_loader = BackgroundPrefetcher(
+        make_loader(
+            train_dataset,
+            batch_size=batch_size,
+            sampler=score_rows,
+            num_workers=val_workers,
+            collate_fn=collate_fn,
+            worker_init_fn=ignore_sigusr1,
+        ),
+        depth=prefetch_batches,
+        batch_transform=batch_transform,
+    )
+coreset_indices = None
+
+# Data loaders, workers persist across epochs
+train_loader = BackgroundPrefetcher(
+    make_loader(
+        train_dataset,
+        batch_size=batch_size,
+        sampler=train_sampler,
+        num_workers=train_workers,
+        collate_fn=collate_fn,
+        worker_init_fn=ignore_sigusr1,
+    ),
+    depth=prefetch_batches,
+    batch_transform=batch_transform,
+)
+val_loader = BackgroundPrefetcher(
+    make_loader(
+        val_dataset,
+        batch_size=batch_size,
+        sampler=(
+            None
+            if data_source == "shards"
+            else ResumableSampler(
+                len(val_dataset), shuffle=False, num_replicas=world_size, rank=rank
+            )
+        ),
+        num_workers=val_workers,
+        collate_fn=collate_fn,
+        worker_init_fn=ignore_sigusr1,
+    ),
+    depth=prefetch_batches,
+    batch_transform=batch_transform,
 )
 
-# Load dataset
-dataset = datasets.ImageFolder(root=data_dir, transform=transform)
+# Validation samples are numbered by position in the split, each rank starting
+# at its block (shards: position in the rank's stream)
+val_offset = 0 if data_source == "shards" else rank * (len(val_dataset) // world_size)
+
+
+def val_sample_name(position):
+    if data_source == "cache":
+        return val_dataset.index["files"][val_dataset.start + position]
+    if data_source == "folder":
+        return dataset.samples[val_dataset.indices[position]][0]
+    return f"val stream position {position}"
 
-# Limit dataset size
-# train_dataset = Subset(dataset, range(100000))  # Use only 100 images for training
-# val_dataset = Subset(dataset, range(100000, 101000))  # Use 10 images for validation
 
-# Split dataset into train and validation sets
-train_size = int(0.9 * len(dataset))
-val_size = len(dataset) - train_size
-train_dataset, val_dataset = random_split(dataset, [train_size, val_size])
+# Fixed images for the reconstruction grid, selected once
+preview_images = select_preview_batch(
+    val_dataset, 8, collate_fn=collate_fn, batch_transform=batch_transform
+).to(device)
 
-# Data loaders
-train_loader = DataLoader(
-    train_dataset, batch_size=batch_size, shuffle=True, num_workers=10
+# Initialize model, optimizer, and loss function
+model_config = dict(
+    in_channels=3,
+    latent_dim=latent_dim,
+    img_size=img_size,
+    hidden_dims=[32, 64, 128, 256, 512],
 )
-val_loader = DataLoader(
-    val_dataset, batch_size=batch_size, shuffle=False, num_workers=4
+
+
+def make_optimizer(model, lr):
+    optimizer = Adam(model.parameters(), lr=lr, weight_decay=weight_decay)
+    if lr_schedule == "plateau":
+        scheduler = lr_scheduler.ReduceLROnPlateau(
+            optimizer, factor=plateau_factor, patience=plateau_patience - 1
+        )
+    else:
+        scheduler = lr_scheduler.ExponentialLR(optimizer, gamma=scheduler_gamma)
+    return optimizer, scheduler
+
+
+def wrap_model(model):
+    # Gradients are averaged across ranks; model stays the unwrapped module
+    train_model = DistributedDataParallel(model) if world_size > 1 else model
+    train_model = CompiledVAE(train_model, compile_mode, compile_cache_dir)
+    # Validation and previews run on the unwrapped model
+    if world_size > 1:
+        return train_model, CompiledVAE(model, compile_mode, compile_cache_dir)
+    return train_model, train_model
+
+
+# With a progressive schedule the model is built for the resolution it was
+# last trained at and batches are downsampled to it
+if resume_state is not None:
+    start_epoch, train_img_size = resume_state["epoch"], resume_state["train_img_size"]
+else:
+    start_epoch = 0
+    train_img_size = resolution_at(progressive_schedule, start_epoch, img_size)
+train_resize = BatchTransform(train_img_size)
+model = build_vae(model_config, train_img_size).to(device)
+enable_checkpointing(model, checkpoint_blocks)
+optimizer, scheduler = make_optimizer(model, learning_rate)
+# TensorBoard, checkpoints and images are only written by rank 0
+writer = SummaryWriter(log_dir) if is_main else None
+checkpointer = AsyncCheckpointer()
+# Loss sums stay on the device and are reduced across ranks once per epoch
+train_metrics = MetricAccumulator(device)
+val_metrics = MetricAccumulator(device)
+worst = WorstSamples(worst_k, device)
+controller = TrainingController(
+    num_epochs,
+    target_elbo=target_elbo,
+    time_budget=time_budget_hours and time_budget_hours * 3600,
+    patience=early_stop_patience,
 )
 
-# Initialize model, optimizer, and loss function
-model = VanillaVAE(in_channels=3, latent_dim=latent_dim).to(device)
-optimizer = Adam(model.parameters(), lr=learning_rate, weight_decay=weight_decay)
-scheduler = lr_scheduler.ExponentialLR(optimizer, gamma=scheduler_gamma)
-writer = SummaryWriter(log_dir)
+start_samples = 0  # position in the epoch's global sample order
+if resume_state is not None:
+    model.load_state_dict(resume_state["model"])
+    optimizer.load_state_dict(resume_state["optimizer"])
+    scheduler.load_state_dict(resume_state["scheduler"])
+    restore_rng_state(resume_state["rng"])
+    # Counted in samples, the position holds for any number of ranks
+    start_samples = resume_state.get(
+        "epoch_samples", resume_state["step"] * batch_size * world_size
+    )
+    train_metrics.load_state_dict(resume_state["train_metrics"])
+    controller.load_state_dict(resume_state["controller"])
+    coreset_indices = resume_state["coreset_indices"]
+    layout = (
+        resume_state.get("world_size", world_size),
+        resume_state.get("train_workers", train_workers),
+    )
+    if (
+        data_source == "shards"
+        and start_samples
+        and layout != (world_size, train_workers)
+    ):
+        # Shards are dealt to (rank, worker) pairs: a new layout restarts the epoch
+        if is_main:
+            print(
+                f"Loader layout changed from {layout}, restarting epoch {start_epoch+1}"
+            )
+        start_samples = 0
+        train_metrics.reset()
+    if is_main:
+        print(f"Resuming at epoch {start_epoch+1}, sample {start_samples}")
+elif init_weights is not None:
+    model.load_state_dict(torch.load(init_weights, map_location=device))
+
+if resume_state is None and lr_range_test_steps:
+    # Rank 0 tests on its own short loader, the others wait for the result
+    if is_main:
+        range_loader = BackgroundPrefetcher(
+            make_loader(
+                train_dataset,
+                batch_size=batch_size,
+                shuffle=data_source != "shards",
+                num_workers=train_workers,
+                collate_fn=collate_fn,
+                worker_init_fn=ignore_sigusr1,
+            ),
+            batch_transform=batch_transform,
+        )
+        found_lr, lr_curve = lr_range_test(
+            model,
+            (train_resize(images.to(device)) for images, _ in range_loader),
+            kld_weight,
+            micro_batch_size,
+            num_steps=lr_range_test_steps,
+        )
+        del range_loader
+        for i, (lr, loss) in enumerate(lr_curve):
+            writer.add_scalar("LRRangeTest/loss", loss, i)
+            writer.add_scalar("LRRangeTest/lr", lr, i)
+        print(f"LR range test: learning_rate {found_lr:.2e} (was {learning_rate})")
+    learning_rate = all_reduce_sum([found_lr if is_main else 0.0])[0]
+    optimizer, scheduler = make_optimizer(model, learning_rate)
+
+train_model, eval_model = wrap_model(model)
+
+# Per-phase step times, written to TensorBoard under Time/
+timer = PhaseTimer(synchronize=device.type == "cuda")
+# SIGTERM/SIGUSR1: finish the step, checkpoint and exit (see preemption.py)
+preemption = PreemptionHandler()
+preempted = False
 
 # Training loop
-for epoch in range(num_epochs):
+for epoch in range(start_epoch, num_epochs):
+    if controller.stop_reason is not None:
+        if is_main:
+            print(f"Run already stopped early: {controller.stop_reason}")
+        break
+    if resolution_at(progressive_schedule, epoch, img_size) != train_img_size:
+        # Grow: add the outer stages, keep every block that still fits
+        train_img_size = resolution_at(progressive_schedule, epoch, img_size)
+        train_resize = BatchTransform(train_img_size)
+        grown = build_vae(model_config, train_img_size).to(device)
+        enable_checkpointing(grown, checkpoint_blocks)
+        copied = transfer_weights(model, grown)
+        grown_optimizer, scheduler = make_optimizer(grown, scheduler.get_last_lr()[0])
+        transfer_optimizer_state(model, optimizer, grown, grown_optimizer, copied)
+        model, optimizer = grown, grown_optimizer
+        train_model, eval_model = wrap_model(model)
+        if is_main:
+            print(f"Training at {train_img_size}px from epoch {epoch+1}")
+
+    epoch_samples = start_samples if epoch == start_epoch else 0
+    step = epoch_samples // (batch_size * world_size)
+    controller.start_epoch()
+    # A new coreset every coreset_refresh epochs; a resumed run keeps its own
+    new_coreset = epoch % coreset_refresh == 0 and epoch_samples == 0
+    if coreset_fraction and (coreset_indices is None or new_coreset):
+        coreset_indices, score_seconds = coreset.refresh(
+            model,
+            score_loader,
+            train_resize,
+            len(train_dataset),
+            coreset_strategy,
+            coreset_fraction,
+            seed=epoch,
+            offset=score_rows.start,
+        )
+        if is_main:
+            writer.add_scalar("Coreset/score_seconds", score_seconds, epoch)
+            writer.add_scalar("Coreset/size", len(coreset_indices), epoch)
+    if coreset_fraction:
+        train_sampler.set_subset(coreset_indices)
+    if data_source == "shards":
+        train_dataset.set_epoch(epoch, skip_batches=step, batch_size=batch_size)
+    else:
+        train_sampler.set_epoch(epoch, start=epoch_samples)
     model.train()
-    train_loss = 0.0
-
-    for batch in tqdm(train_loader, desc=f"Epoch {epoch+1}/{num_epochs}"):
+    profiler = None
+    if is_main and epoch == profile_epoch:
+        profiler = make_profiler(os.path.join(log_dir, "profile"))
+        profiler.start()
+
+    timer.reset()
+    for batch in tqdm(
+        train_loader,
+        desc=f"Epoch {epoch+1}/{num_epochs}",
+        initial=step,
+        total=step + len(train_loader),
+        disable=not is_main,
+    ):
+        timer.start_step()
         images, _ = batch
-        images = images.to(device)
+        images = train_resize(images.to(device))
 
         optimizer.zero_grad()
 
-        outputs = model(images)
-        loss_dict = model.loss_function(*outputs, M_N=kld_weight)
-        loss = loss_dict["loss"]
-        loss.backward()
-        optimizer.step()
-
-        train_loss += loss.item()
+        micro_batches = images.split(micro_batch_size or len(images))
+        for i, micro_images in enumerate(micro_batches):
+            # Gradients are only all-reduced after the last micro-batch
+            last = i == len(micro_batches) - 1
+            with contextlib.nullcontext() if last else train_model.no_sync():
+                with timer.phase("forward"):
+                    with torch.autocast(
+                        device.type, dtype=torch.bfloat16, enabled=use_bf16
+                    ):
+                        outputs = train_model(micro_images)
+                    # MSE and KLD sums in fp32
+                    outputs = [output.float() for output in outputs]
+                    loss_dict = model.loss_function(*outputs, M_N=kld_weight)
+                    # Both terms are batch means: weight each micro-batch by its
+                    # share so the summed gradients match the full batch
+                    loss = loss_dict["loss"] * (len(micro_images) / len(images))
+                with timer.phase("backward"):
+                    loss.backward()
+            train_metrics.update(loss_dict, len(micro_images))
+        with timer.phase("optimizer"):
+            optimizer.step()
+
+        step += 1
+        epoch_samples += batch_size * world_size
+
+        preempted = preemption.should_stop()
+        if is_main and (preempted or step % checkpoint_interval == 0):
+            checkpointer.save(
+                training_state(
+                    model,
+                    optimizer,
+                    scheduler,
+                    epoch,
+                    step,
+                    epoch_samples=epoch_samples,
+                    world_size=world_size,
+                    train_workers=train_workers,
+                    train_metrics=train_metrics.state_dict(),
+                    controller=controller.state_dict(),
+                    coreset_indices=coreset_indices,
+                    train_img_size=train_img_size,
+                    **split_state,
+                ),
+                checkpoint_path,
+            )
 
-    scheduler.step()
+        timer.end_step(images.shape[0])
+        if profiler is not None:
+            profiler.step()
+        if preempted:
+            break
+
+    if profiler is not None:
+        profiler.stop()
+    if preempted:
+        if is_main:
+            print(
+                f"{preemption.received or 'Signal on another rank'}: stopped at "
+                f"epoch {epoch+1}, sample {epoch_samples}, checkpoint saved"
+            )
+        break
 
-    avg_train_loss = train_loss / len(train_loader)
-    writer.add_scalar("Loss/Train", avg_train_loss, epoch)
+    avg_train_loss = train_metrics.compute()["loss"]
+    train_metrics.reset()
+    if is_main:
+        writer.add_scalar("Loss/Train", avg_train_loss, epoch)
+        timer.write_scalars(writer, epoch)
 
     # Validation loop
-    model.eval()
-    val_loss = 0.0
-    with torch.no_grad():
-        for batch in val_loader:
-            images, _ = batch
-            images = images.to(device)
-
-            outputs = model(images)
-            loss_dict = model.loss_function(*outputs, M_N=kld_weight)
-            val_loss += loss_dict["loss"].item()
-
-    avg_val_loss = val_loss / len(val_loader)
-    writer.add_scalar("Loss/Validation", avg_val_loss, epoch)
-    writer.add_scalar("Loss/Reconstruction", loss_dict["Reconstruction_Loss"], epoch)
-    writer.add_scalar("Loss/KLD", loss_dict["KLD"], epoch)
+    validate = (
+        val_interval > 0
+        and val_batches != 0
+        and ((epoch + 1) % val_interval == 0 or epoch + 1 == num_epochs)
+    )
+    if validate:
+        model.eval()
+        val_metrics.reset()
+        worst.reset()
+        position = val_offset
+        with torch.no_grad():
+            for batch in itertools.islice(val_loader, val_batches):
+                images, _ = batch
+                images = train_resize(images.to(device))
+
+                with torch.autocast(
+                    device.type, dtype=torch.bfloat16, enabled=use_bf16
+                ):
+                    outputs = eval_model(images)
+                outputs = [output.float() for output in outputs]
+                losses = model.loss_function(*outputs, M_N=kld_weight, reduction="none")
+                loss_dict = {name: value.mean() for name, value in losses.items()}
+                val_metrics.update(loss_dict, images.shape[0])
+                if worst_k:
+                    positions = torch.arange(position, position + len(images))
+                    worst.update(
+                        losses["Reconstruction_Loss"], positions, images, outputs[0]
+                    )
+                position += len(images)
+
+        val_averages = val_metrics.compute()
+        avg_val_loss = val_averages["loss"]
+        if is_main:
+            writer.add_scalar("Loss/Validation", avg_val_loss, epoch)
+            writer.add_scalar(
+                "Loss/Reconstruction", val_averages["Reconstruction_Loss"], epoch
+            )
+            writer.add_scalar("Loss/KLD", val_averages["KLD"], epoch)
+
+        if worst_k:
+            scores, positions, worst_images, worst_recons = worst.result()
+            if is_main and len(scores):
+                # Originals on the first row, reconstructions below
+                utils.save_image(
+                    torch.cat([worst_images, worst_recons]).cpu(),
+                    os.path.join(results_dir, f"worst_epoch_{epoch+1}.png"),
+                    nrow=len(scores),
+                    normalize=True,
+                )
+                with open(
+                    os.path.join(results_dir, f"worst_epoch_{epoch+1}.txt"), "w"
+                ) as f:
+                    for score, pos in zip(scores.tolist(), positions.tolist()):
+                        f.write(f"{score:.6f}\t{val_sample_name(pos)}\n")
+
+    if lr_schedule != "plateau":
+        scheduler.step()
+    elif validate or val_interval == 0 or val_batches == 0:
+        # Without inline validation the plateau is judged on the train loss
+        scheduler.step(avg_val_loss if validate else avg_train_loss)
+
+    stop = controller.end_epoch(
+        epoch,
+        avg_val_loss if validate else None,
+        # KLD is reported negated by loss_function
+        val_averages["Reconstruction_Loss"] - val_averages["KLD"] if validate else None,
+    )
+    # Timing differs between ranks: stop together if any of them decided to
+    stop = all_reduce_sum([float(stop is not None)])[0] > 0
+    if stop and controller.stop_reason is None:
+        # Only the time budget can differ between ranks. Set before the
+        # checkpoint below, so a relaunch does not train past the stop
+        controller.stop_reason = "time budget on another rank"
+
+    if not is_main:
+        if stop:
+            break
+        continue
 
     if epoch % 10 == 0:
         # Save model checkpoint
-        torch.save(
+        checkpointer.save(
             model.state_dict(), os.path.join(weights_dir, f"vae_epoch_{epoch+1}.pth")
         )
 
+    # Full checkpoint at every epoch boundary, written in the background
+    checkpointer.save(
+        training_state(
+            model,
+            optimizer,
+            scheduler,
+            epoch + 1,
+            0,
+            train_metrics=train_metrics.state_dict(),
+            controller=controller.state_dict(),
+            coreset_indices=coreset_indices,
+            train_img_size=train_img_size,
+            **split_state,
+        ),
+        checkpoint_path,
+    )
+    if eval_checkpoints:
+        # One file per epoch, evaluator.py removes it once evaluated. Not
+        # overwritten by mid-epoch checkpoints like checkpoint_last.pth
+        checkpointer.save(
+            {
+                "model": model.state_dict(),
+                "epoch": epoch + 1,
+                "step": 0,
+                "controller": controller.state_dict(),
+                "train_img_size": train_img_size,
+                "val_indices": split_state["val_indices"],
+            },
+            os.path.join(weights_dir, f"checkpoint_epoch_{epoch+1}.pth"),
+        )
+
     # Generate and save examples
+    model.eval()
     with torch.no_grad():
-        sample_images, _ = next(iter(val_loader))
-        sample_images = sample_images.to(device)
-        reconstructed_images, _, _, _ = model(sample_images)
-        comparison = torch.cat([sample_images[:8], reconstructed_images[:8]])
+        previews = train_resize(preview_images)
+        reconstructed_images, _, _, _ = eval_model(previews)
+        comparison = torch.cat([previews, reconstructed_images])
         utils.save_image(
             comparison.cpu(),
             os.path.join(results_dir, f"reconstruction_epoch_{epoch+1}.png"),
@@ -296,10 +642,22 @@ for epoch in range(num_epochs):
             normalize=True,
         )
 
-    print(
-        f"Epoch [{epoch+1}/{num_epochs}], Train Loss: {avg_train_loss:.4f}, Validation Loss: {avg_val_loss:.4f}"
-    )
+    if validate:
+        print(
+            f"Epoch [{epoch+1}/{num_epochs}], Train Loss: {avg_train_loss:.4f}, Validation Loss: {avg_val_loss:.4f}"
+        )
+    else:
+        print(f"Epoch [{epoch+1}/{num_epochs}], Train Loss: {avg_train_loss:.4f}")
+
+    if stop:
+        report = controller.report(epoch)
+        print(report)
+        writer.add_text("Controller", report, epoch)
+        break
 
 
-# Close TensorBoard writer
-writer.close()
+# Wait for pending checkpoint writes and close TensorBoard writer
+checkpointer.close()
+if is_main:
+    writer.close()
+cleanup_distributed()
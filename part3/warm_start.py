@@ -0,0 +1,99 @@
+import os
+from typing import List, Optional, Tuple
+
+import torch
+
+from log_curves import validation_curve
+from progressive import transfer_weights
+from vae_model import VanillaVAE, configs
+
+# Weight surgery from the 64px model (celeba64) to the 128px one (celeba128).
+#
+# The 128px model has the same five encoder stages plus a 512 -> 1024 stage at
+# the bottom, and the same four decoder stages plus a 1024 -> 512 one at the
+# top, with an identical final_layer. Those blocks are copied as they are.
+# Only the new stages and the linear layers around the latent (fc_mu, fc_var,
+# decoder_input: different bottleneck and latent_dim) keep their fresh
+# initialization.
+#
+#   python warm_start.py          writes dst_path from src_path
+#   init_weights = dst_path       in vae_train_128.py, then train as usual
+#
+# With TensorBoard logs of a from-scratch and a warm-started 128px run,
+# running it again also reports the wall-clock time each run needed to reach
+# the scratch run's best validation loss (the 64px training is not counted,
+# its weights are a by-product of training that model anyway).
+
+src_path = "./weights/vae_epoch_91.pth"  # 64px state_dict or full checkpoint
+dst_path = "./weights/vae_128_from_64.pth"
+scratch_log_dir = "./logs/celeba128_scratch/"
+warm_log_dir = "./logs/celeba128_warm/"
+target_loss = None  # validation loss to reach, None for the scratch run's best
+
+
+def load_weights(path: str) -> dict:
+    state = torch.load(path, map_location="cpu")
+    # Full checkpoints (checkpoint.training_state) keep the weights under "model"
+    return state["model"] if "optimizer" in state else state
+
+
+def warm_start(
+    src_state: dict, src_config: str = "celeba64", dst_config: str = "celeba128"
+) -> Tuple[dict, List[str]]:
+    """Map a src_config state_dict into dst_config; returns it and the keys left new."""
+    src = VanillaVAE(**configs[src_config])
+    src.load_state_dict(src_state)
+    dst = VanillaVAE(**configs[dst_config])
+    # Stages line up from the input side; dst's extra decoder stage comes first
+    copied = transfer_weights(
+        src,
+        dst,
+        encoder_offset=0,
+        decoder_offset=len(dst.decoder) - len(src.decoder),
+    )
+    targets = {target for _, target in copied}
+    return dst.state_dict(), [key for key in dst.state_dict() if key not in targets]
+
+
+def time_to_loss(curve, target: float) -> Optional[Tuple[float, int]]:
+    for seconds, epoch, loss in curve:
+        if loss <= target:
+            return seconds, epoch
+    return None
+
+
+def compare_runs(
+    scratch_log_dir: str, warm_log_dir: str, target: Optional[float] = None
+) -> dict:
+    scratch = validation_curve(scratch_log_dir)
+    warm = validation_curve(warm_log_dir)
+    if target is None:
+        target = min(loss for _, _, loss in scratch)
+    report = {"target_loss": target}
+    for name, curve in (("scratch", scratch), ("warm", warm)):
+        reached = time_to_loss(curve, target)
+        report[f"{name}_seconds"], report[f"{name}_epoch"] = reached or (None, None)
+    if report["scratch_seconds"] is not None and report["warm_seconds"] is not None:
+        report["saved_seconds"] = report["scratch_seconds"] - report["warm_seconds"]
+    return report
+
+
+if __name__ == "__main__":
+    state, new_keys = warm_start(load_weights(src_path))
+    torch.save(state, dst_path)
+    print(f"Wrote {dst_path}, {len(state) - len(new_keys)}/{len(state)} tensors copied")
+    print(
+        "Newly initialized:", ", ".join(sorted({k.rsplit(".", 1)[0] for k in new_keys}))
+    )
+
+    if os.path.isdir(scratch_log_dir) and os.path.isdir(warm_log_dir):
+        report = compare_runs(scratch_log_dir, warm_log_dir, target_loss)
+        print(f"Time to validation loss {report['target_loss']:.4f}:")
+        for name in ("scratch", "warm"):
+            seconds, epoch = report[f"{name}_seconds"], report[f"{name}_epoch"]
+            if seconds is None:
+                print(f"  {name:>7}: not reached")
+            else:
+                print(f"  {name:>7}: {seconds:.0f} s (epoch {epoch + 1})")
+        if "saved_seconds" in report:
+            print(f"  saved {report['saved_seconds']:.0f} s")